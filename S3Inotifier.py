@@ -11,26 +11,64 @@ import pyinotify  # @UnresolvedImport
 import Queue
 import logging
 import os.path
-from collections import namedtuple
-from threading import Thread
+from collections import namedtuple, OrderedDict
+from threading import Thread, Lock
+import threading
+from multiprocessing.pool import Pool, ThreadPool
+import heapq
+import select
+import signal
+import errno
+import re
 from datetime import datetime
 import hds_seg_fragmenter
 from _collections import deque
 import glob
-import sys
 import time
+import base64
+import binascii
+import shutil
+import tempfile
 from Queue import Empty
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
 from hds_seg_fragmenter import HDSSegSplitterException
+from fragment_index import FragmentIndex, digest_of
+from bootstrap_diff import BootstrapPublisher, BootstrapDiffException, prepare_bootstrap
 
 FILE_PROCESSOR_THREAD_COUNT = 20
 S3_UPLOADER_THREAD_COUNT = 20
 THREAD_TIMEOUT = 10
 
+# Event loop mode
+SPLIT_PROCESS_COUNT = 4
+UPLOAD_CONCURRENCY = 20
+MANIFEST_SETTLE_SECONDS = 3
+
+# A stream is live if it has queued an upload within this window
+LIVE_STREAM_WINDOW_SECONDS = 30
+# A .bootstrap is published anyway if its live edge fragment hasn't been
+# uploaded within this time, e.g. because it was quarantined
+BOOTSTRAP_HOLD_SECONDS = 30
+LAG_REPORT_SECONDS = 10
+
+INOTIFY_MASK = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MODIFY
+
+MIME_TYPES = {".bootstrap": "application/binary",
+              ".f4m":       "application/f4m"}
+
+SPLIT_STRATEGIES = ["split", "split_linear"]
+
 PROCESSED_FRAGMENT_INDEX_LENGTH = 2000
+UPLOAD_INDEX_LENGTH = 20000
+POISONED_SEGMENT_INDEX_LENGTH = 200
 
-TransferFile = namedtuple("TransferFile", ["create_time", "remote_filename", "payload", "content_type"])
+# live_edge_fragment is the fragment number a .bootstrap advertises, None for other files
+TransferFile = namedtuple("TransferFile", ["create_time", "remote_filename", "payload", "content_type", "digest",
+                                           "live_edge_fragment"])
+SplitResult = namedtuple("SplitResult", ["f4x_filename", "stream_name", "fragments", "quarantine_reasons", "error"])
+# transfer_file is None if the .bootstrap couldn't be read, prepared_bootstrap is None if it couldn't be parsed
+BootstrapResult = namedtuple("BootstrapResult", ["pathname", "transfer_file", "prepared_bootstrap", "error"])
 
 class NullHandler(logging.Handler):
     def emit(self, record):
@@ -40,6 +78,125 @@ log = logging.getLogger("S3Inotifer")
 log.addHandler(NullHandler())
 log.setLevel(logging.DEBUG)
 
+def fragment_remote_filename(stream_name, fragment):
+    return fragment_name(stream_name, fragment.segment_number, fragment.number)
+
+def fragment_name(stream_name, segment_number, fragment_number):
+    return "{stream_name}Seg{segment_number}-Frag{fragment_number}".format(stream_name=stream_name,
+                                                                           segment_number=segment_number,
+                                                                           fragment_number=fragment_number)
+
+def read_transfer_file(pathname):
+    """ Returns a TransferFile of a .bootstrap or .f4m """
+    
+    payload = open(pathname, "rb").read()
+    extension = os.path.splitext(pathname)[1].lower()
+    
+    return TransferFile(create_time=datetime.now(),
+                        remote_filename=os.path.basename(pathname),
+                        payload=payload,
+                        content_type=MIME_TYPES[extension],
+                        digest=digest_of(payload),
+                        live_edge_fragment=None)
+
+def read_bootstrap_transfer_file(pathname, bootstrap_publisher):
+    """ Returns a TransferFile of a .bootstrap, or None if it doesn't need
+    publishing, is still being written or has gone """
+    
+    try:
+        tf = read_transfer_file(pathname)
+    except IOError as e:
+        log.warn("Problem while reading %s: %s", pathname, e)
+        return None
+    
+    try:
+        prepared_bootstrap = bootstrap_publisher.publishable_bootstrap(pathname, tf.payload)
+    except BootstrapDiffException as e:
+        # another event follows once the packager finishes writing
+        log.debug("Not publishing %s yet: %s", pathname, e)
+        return None
+    
+    if prepared_bootstrap is None:
+        log.debug("Skipping bootstrap without a new live edge: %s", tf.remote_filename)
+        return None
+    
+    return publishable_transfer_file(tf, prepared_bootstrap)
+
+def prepare_bootstrap_file(pathname, dvr_window=None):
+    """ Reads and parses a .bootstrap in a worker process. Comparing it with
+    the published one is left to the event loop. Errors are returned rather
+    than raised, as split_segment does """
+    
+    try:
+        tf = read_transfer_file(pathname)
+    except IOError as e:
+        return BootstrapResult(pathname=pathname, transfer_file=None, prepared_bootstrap=None, error=str(e))
+    
+    try:
+        prepared_bootstrap = prepare_bootstrap(tf.payload, dvr_window)
+    except BootstrapDiffException as e:
+        return BootstrapResult(pathname=pathname, transfer_file=tf, prepared_bootstrap=None, error=str(e))
+    
+    return BootstrapResult(pathname=pathname, transfer_file=tf, prepared_bootstrap=prepared_bootstrap, error=None)
+
+def publishable_transfer_file(tf, prepared_bootstrap):
+    """ Returns the TransferFile of a .bootstrap as it is to be published """
+    
+    live_edge = prepared_bootstrap.snapshot.live_edge
+    tf = tf._replace(live_edge_fragment=live_edge.fragment_number if live_edge else None)
+    
+    payload = prepared_bootstrap.publish_payload
+    if payload is not tf.payload:
+        tf = tf._replace(payload=payload, digest=digest_of(payload))
+    
+    return tf
+
+def upload_transfer_file(file_adapter, upload_index, base_directory, tf):
+    """ Uploads tf unless the index shows it's unchanged. Returns True if uploaded """
+    
+    filename = os.path.join(base_directory, "hds", tf.remote_filename)
+    
+    if upload_index.is_unchanged(filename, tf.digest):
+        log.info("Skipping unchanged upload of %s", tf.remote_filename)
+        return False
+    
+    if file_adapter.upload(filename=filename,
+                 contents_bytes=tf.payload, content_type=tf.content_type,
+                 md5=tf.digest.md5):
+        upload_index.record(filename, tf.digest)
+        time_to_upload = datetime.now() - tf.create_time 
+        log.info("Uploading of %s took %d seconds from modification", tf.remote_filename, time_to_upload.seconds)
+        return True
+    
+    return False
+
+def split_segment(f4x_filename, split_strategy="split", large_file=None, processed_frags=()):
+    """ Splits a segment in a worker process. Only fragments whose remote
+    filenames aren't in processed_frags are returned, so that fragments
+    already queued aren't copied back to the event loop on every .f4x
+    rewrite. Errors are returned rather than raised so that they reach the
+    event loop """
+    
+    try:
+        splitter = hds_seg_fragmenter.HDSSegSplitter(f4x_filename, large_file=large_file)
+        processed_frags = frozenset(processed_frags)
+        fragments = [fragment for fragment in getattr(splitter, split_strategy)(verify=True)
+                     if fragment_remote_filename(splitter.stream_name, fragment) not in processed_frags]
+        return SplitResult(f4x_filename=f4x_filename, stream_name=splitter.stream_name, fragments=fragments,
+                           quarantine_reasons=[q.reason for q in splitter.quarantined], error=None)
+    except Exception as e:
+        return SplitResult(f4x_filename=f4x_filename, stream_name=None, fragments=[],
+                           quarantine_reasons=[], error=str(e) or repr(e))
+
+def log_live_edge_lags(upload_scheduler):
+    for lag in upload_scheduler.live_edge_lags():
+        log.info("Live edge lag of %s: %d fragments, %.1f seconds", lag.stream_name, 
+                 lag.fragments_behind, lag.seconds_behind)
+
+def _ignore_sigint():
+    """ Worker processes leave SIGINT to the event loop, which drains them """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
 class S3UploadAdapter(object):
     """ Reference upload class. Could easily implement FTP or SCP """
     
@@ -47,7 +204,7 @@ class S3UploadAdapter(object):
         self.s3_conn = S3Connection(access_key, secret)
         self.bucket = self.s3_conn.get_bucket(bucket_name)
 
-    def upload(self, filename, contents_bytes, content_type=None):
+    def upload(self, filename, contents_bytes, content_type=None, md5=None):
         file_key = Key(bucket=self.bucket, name=filename)
         
 #         if file_key.exists():
@@ -60,19 +217,63 @@ class S3UploadAdapter(object):
         log.info("Setting content_type of %s as %s", filename, content_type)
         file_key.content_type = content_type
         
+        # a precomputed md5 saves boto from hashing the payload again
+        md5_tuple = (md5, base64.b64encode(binascii.unhexlify(md5))) if md5 else None
+        
         log.info("Uploading %s", filename)
-        file_key.set_contents_from_string(contents_bytes, replace=True)
+        file_key.set_contents_from_string(contents_bytes, replace=True, md5=md5_tuple)
+        return True
+
+class LocalObjectStoreAdapter(object):
+    """ Stand-in for S3UploadAdapter which stores objects in a local directory.
+    Allows the daemon to run offline. The ETags and content types of only the
+    maxlen most recently stored objects are remembered """
+    
+    def __init__(self, store_directory, maxlen=UPLOAD_INDEX_LENGTH):
+        self.store_directory = store_directory
+        self.maxlen = maxlen
+        self.etags = OrderedDict()
+        self.content_types = OrderedDict()
+    
+    def upload(self, filename, contents_bytes, content_type=None, md5=None):
+        store_filename = os.path.join(self.store_directory, filename.lstrip("/"))
+        store_dir = os.path.dirname(store_filename)
+        
+        if not os.path.exists(store_dir):
+            try:
+                os.makedirs(store_dir)
+            except OSError:
+                # created by another uploader
+                pass
+        
+        temp_object = tempfile.NamedTemporaryFile(dir=store_dir, delete=False)
+        temp_object.write(contents_bytes)
+        temp_object.close()
+        shutil.move(temp_object.name, store_filename)
+        
+        log.info("Stored %s", store_filename)
+        
+        # re-inserted so that the oldest objects are dropped first
+        self.etags.pop(filename, None)
+        self.content_types.pop(filename, None)
+        self.etags[filename] = md5 or digest_of(contents_bytes).md5
+        self.content_types[filename] = content_type
+        
+        while len(self.etags) > self.maxlen:
+            self.etags.popitem(last=False)
+            self.content_types.popitem(last=False)
         return True
 
 class UploadQueueProcessor(Thread):
     
-    def __init__(self, base_directory, file_send_queue, file_adapter):
+    def __init__(self, base_directory, file_send_queue, file_adapter, upload_index):
         Thread.__init__(self)
         self.go = True
         
         self.base_directory = base_directory
         self.file_queue = file_send_queue
         self.file_adapter = file_adapter
+        self.upload_index = upload_index
         
     def stop(self):
         self.go = False
@@ -88,12 +289,333 @@ class UploadQueueProcessor(Thread):
                 continue
             
             if tf:
-                filename = os.path.join(self.base_directory, "hds", tf.remote_filename)
+                try:
+                    upload_transfer_file(self.file_adapter, self.upload_index, self.base_directory, tf)
+                finally:
+                    self.file_queue.task_done(tf)
+
+LiveEdgeLag = namedtuple("LiveEdgeLag", ["stream_name", "fragments_behind", "seconds_behind"])
+
+class UploadScheduler(object):
+    """ Queue of TransferFiles for the upload stage, with the get/put
+    interface of Queue.Queue. 
+    
+    Fragments of live streams go first, newest fragment first, so that the
+    live edge isn't stuck behind a catch-up burst. A stream's .bootstrap is
+    held back until the live edge fragment it advertises has been uploaded,
+    so players aren't sent to a fragment which isn't there yet. Older
+    fragments of a backlog don't hold it back. A waiting .bootstrap is only
+    replaced by one which advertises the same or a later fragment. Uploaders
+    must call task_done(tf) once they are finished with a TransferFile.
+    
+    With prioritise=False other files are handed out in the order they were
+    put, as the original FIFO queue did. .bootstraps are still held """
+    
+    FRAGMENT_PATTERN = re.compile(r"^(?P<stream_name>.*)Seg(?P<segment_number>\d+)-Frag(?P<fragment_number>\d+)$")
+    
+    class StreamState(object):
+        def __init__(self):
+            self.fragments = []            # heap, newest fragment first
+            self.bootstrap = None          # (live edge fragment number, held since, tf) of the newest waiting .bootstrap
+            self.outstanding = {}          # sequence -> fragment number, for fragments queued or uploading
+            self.last_activity = 0
+            self.last_published = 0
+            self.newest_queued = None      # (fragment number, create_time)
+            self.newest_dispatched = 0     # fragment number
+            self.newest_published = 0      # fragment number
+    
+    def __init__(self, prioritise=True, live_window=LIVE_STREAM_WINDOW_SECONDS, bootstrap_hold=BOOTSTRAP_HOLD_SECONDS):
+        self.prioritise = prioritise
+        self.live_window = live_window
+        self.bootstrap_hold = bootstrap_hold
+        
+        self._streams = {}
+        self._others = deque()             # .f4m and anything else, sent first
+        self._fifo = deque()
+        self._in_flight = {}               # id(tf) -> sequence, for fragments being uploaded
+        self._sequence = 0
+        self._queued_count = 0
+        self._condition = threading.Condition()
+    
+    def put(self, tf, block=True, timeout=None):
+        with self._condition:
+            self._sequence += 1
+            sequence = self._sequence
+            stream_name, fragment_number = self._classify(tf)
+            
+            if stream_name is not None:
+                stream = self._streams.setdefault(stream_name, self.StreamState())
+                stream.last_activity = time.time()
+            
+            if fragment_number is not None:
+                stream.outstanding[sequence] = fragment_number
+                if stream.newest_queued is None or fragment_number > stream.newest_queued[0]:
+                    stream.newest_queued = (fragment_number, tf.create_time)
+            
+            if stream_name is not None and fragment_number is None:
+                # .bootstraps are held in FIFO mode too
+                if not self._hold_bootstrap(stream, tf):
+                    return
+            elif not self.prioritise:
+                self._fifo.append((sequence, stream_name, fragment_number, tf))
+            elif fragment_number is not None:
+                heapq.heappush(stream.fragments, (-fragment_number, sequence, tf))
+            else:
+                self._others.append(tf)
+            
+            self._queued_count += 1
+            self._condition.notify()
+    
+    def put_nowait(self, tf):
+        self.put(tf, block=False)
+    
+    def get(self, block=True, timeout=None):
+        """ Returns the next TransferFile. Raises Queue.Empty, as Queue.get does """
+        
+        with self._condition:
+            deadline = None if timeout is None else time.time() + timeout
+            
+            while True:
+                tf = self._next()
+                if tf is not None:
+                    self._queued_count -= 1
+                    return tf
+                
+                if not block:
+                    raise Empty
+                
+                wait_time = None
+                if deadline is not None:
+                    wait_time = deadline - time.time()
+                    if wait_time <= 0:
+                        raise Empty
+                
+                # held bootstraps are released by time, without a notify
+                release_time = self.next_release_time()
+                if release_time is not None:
+                    release_wait = max(0, release_time - time.time())
+                    wait_time = release_wait if wait_time is None else min(wait_time, release_wait)
                 
-                if self.file_adapter.upload(filename=filename,
-                             contents_bytes=tf.payload, content_type=tf.content_type):
-                    time_to_upload = datetime.now() - tf.create_time 
-                    log.info("Uploading of %s took %d seconds from modification", tf.remote_filename, time_to_upload.seconds)
+                self._condition.wait(wait_time)
+    
+    def get_nowait(self):
+        return self.get(block=False)
+    
+    def task_done(self, tf):
+        """ Marks tf as uploaded (or given up on), releasing any .bootstrap
+        waiting on it """
+        
+        with self._condition:
+            stream_name, fragment_number = self._classify(tf)
+            
+            if fragment_number is not None:
+                stream = self._streams[stream_name]
+                stream.outstanding.pop(self._in_flight.pop(id(tf)), None)
+                stream.last_published = time.time()
+                stream.newest_published = max(stream.newest_published, fragment_number)
+                self._condition.notify_all()
+    
+    def empty(self):
+        return len(self) == 0
+    
+    def qsize(self):
+        return len(self)
+    
+    def __len__(self):
+        return self._queued_count
+    
+    def live_edge_lags(self):
+        """ Returns a LiveEdgeLag per stream: how many queued or uploading
+        fragments are newer than the newest published one, and for how many
+        seconds the newest fragment has been waiting to be published """
+        
+        lags = []
+        now = datetime.now()
+        
+        with self._condition:
+            for stream_name, stream in sorted(self._streams.items()):
+                if stream.newest_queued is None:
+                    continue
+                
+                newest_fragment_number, newest_create_time = stream.newest_queued
+                fragments_behind = sum(1 for fragment_number in stream.outstanding.values()
+                                       if fragment_number > stream.newest_published)
+                
+                if newest_fragment_number > stream.newest_published:
+                    seconds_behind = (now - newest_create_time).total_seconds()
+                else:
+                    seconds_behind = 0.0
+                
+                lags.append(LiveEdgeLag(stream_name=stream_name, fragments_behind=fragments_behind,
+                                        seconds_behind=seconds_behind))
+        return lags
+    
+    def next_release_time(self):
+        """ Returns the time at which the longest held .bootstrap is published
+        anyway, or None if none are held """
+        
+        with self._condition:
+            held_since_times = [stream.bootstrap[1] for stream in self._streams.values() if stream.bootstrap is not None]
+        
+        if not held_since_times:
+            return None
+        return min(held_since_times) + self.bootstrap_hold
+    
+    def _hold_bootstrap(self, stream, tf):
+        """ Makes tf the stream's waiting .bootstrap. Returns False if it
+        advertises an older fragment than the one already waiting. Holds the lock """
+        
+        if stream.bootstrap is not None:
+            waiting_live_edge_fragment = stream.bootstrap[0]
+            
+            if None not in (waiting_live_edge_fragment, tf.live_edge_fragment) and \
+                    tf.live_edge_fragment < waiting_live_edge_fragment:
+                log.debug("Dropping %s, older than the queued one", tf.remote_filename)
+                return False
+            
+            # a newer bootstrap supersedes the waiting one
+            log.debug("Superseding queued %s", tf.remote_filename)
+            self._queued_count -= 1
+        
+        stream.bootstrap = (tf.live_edge_fragment, time.time(), tf)
+        return True
+    
+    def _classify(self, tf):
+        """ Returns (stream name, fragment number). Both are None for files
+        which don't belong to a stream """
+        
+        match = self.FRAGMENT_PATTERN.match(tf.remote_filename)
+        if match:
+            return match.group("stream_name"), int(match.group("fragment_number"))
+        
+        stream_name, extension = os.path.splitext(tf.remote_filename)
+        if extension.lower() == ".bootstrap":
+            return stream_name, None
+        
+        return None, None
+    
+    def _next(self):
+        """ Pops the next TransferFile, or returns None. Holds the lock """
+        
+        now = time.time()
+        
+        if not self.prioritise:
+            tf = self._next_bootstrap(now)
+            if tf is not None:
+                return tf
+            
+            if not self._fifo:
+                return None
+            sequence, stream_name, fragment_number, tf = self._fifo.popleft()
+            if fragment_number is not None:
+                self._dispatched(self._streams[stream_name], fragment_number, sequence, tf)
+            return tf
+        
+        if self._others:
+            return self._others.popleft()
+        
+        # bootstraps are tiny and are what players poll, so go as soon as allowed
+        tf = self._next_bootstrap(now)
+        if tf is not None:
+            return tf
+        
+        best_stream = None
+        best_key = None
+        
+        for stream in self._streams.values():
+            if not stream.fragments:
+                continue
+            
+            top_fragment_number = -stream.fragments[0][0]
+            key = (now - stream.last_activity <= self.live_window,          # live streams first
+                   top_fragment_number > stream.newest_dispatched,          # live edge not yet on its way first
+                   -stream.last_published)                                  # then least recently served
+            
+            if best_key is None or key > best_key:
+                best_stream, best_key = stream, key
+        
+        if best_stream is None:
+            return None
+        
+        negative_fragment_number, sequence, tf = heapq.heappop(best_stream.fragments)
+        self._dispatched(best_stream, -negative_fragment_number, sequence, tf)
+        return tf
+    
+    def _next_bootstrap(self, now):
+        """ Pops a .bootstrap whose live edge fragment has been uploaded, or
+        which has been held for too long, or returns None. Holds the lock """
+        
+        for stream in self._streams.values():
+            if stream.bootstrap is not None:
+                live_edge_fragment, held_since, tf = stream.bootstrap
+                
+                if live_edge_fragment is None or (stream.newest_published >= live_edge_fragment and 
+                                                  live_edge_fragment not in stream.outstanding.values()):
+                    stream.bootstrap = None
+                    return tf
+                
+                if now - held_since > self.bootstrap_hold:
+                    log.warn("Publishing %s although fragment %d hasn't been uploaded after %d seconds",
+                             tf.remote_filename, live_edge_fragment, self.bootstrap_hold)
+                    stream.bootstrap = None
+                    return tf
+        
+        return None
+    
+    def _dispatched(self, stream, fragment_number, sequence, tf):
+        self._in_flight[id(tf)] = sequence
+        stream.newest_dispatched = max(stream.newest_dispatched, fragment_number)
+
+class PoisonedSegmentIndex(object):
+    """ Remembers segments which failed to split, keyed on the size and mtime of
+    the .f4x and .f4f, so that they are not re-parsed on every following event.
+    A segment is tried again as soon as either file changes on disk. Segments
+    whose files have gone, e.g. rolled out of the DVR window, aren't poisoned.
+    
+    Take the signature before splitting and poison with it, so that a segment
+    which grew during a failed split isn't skipped afterwards """
+    
+    def __init__(self, maxlen=POISONED_SEGMENT_INDEX_LENGTH):
+        self.maxlen = maxlen
+        self._segments = OrderedDict()
+        self._lock = Lock()
+        
+    def signature(self, splitter):
+        """ Returns None if either file has gone """
+        signature = []
+        for filename in (splitter.f4x_filename, splitter.f4f_filename):
+            try:
+                file_stat = os.stat(filename)
+            except OSError:
+                return None
+            signature.extend([file_stat.st_size, file_stat.st_mtime])
+        return tuple(signature)
+    
+    def is_poisoned(self, splitter, signature=None):
+        """ signature, if given, is the one taken for the split about to start """
+        with self._lock:
+            poisoned_signature = self._segments.get(splitter.f4x_filename)
+        
+        if poisoned_signature is None:
+            return False
+        
+        return poisoned_signature == (signature or self.signature(splitter))
+    
+    def poison(self, splitter, signature, reason):
+        """ signature is the one taken before the failed split started """
+        
+        if signature is None:
+            log.info("Not poisoning removed segment %s: %s", splitter.f4x_filename, reason)
+            return
+        
+        log.warn("Poisoning segment %s: %s", splitter.f4x_filename, reason)
+        
+        with self._lock:
+            self._segments.pop(splitter.f4x_filename, None)
+            self._segments[splitter.f4x_filename] = signature
+            
+            while len(self._segments) > self.maxlen:
+                self._segments.popitem(last=False)
 
 class EventHandler(pyinotify.ProcessEvent):
     """ Picks up inotify events and moves them to file_processor_queue """
@@ -117,13 +639,18 @@ class FileProcessor(Thread):
     """ Picks up events from file_processor_queue and adds files and fragments
     to data to file_send_queue """
     
-    def __init__(self, file_processor_queue, file_send_queue, processed_frags):
+    def __init__(self, file_processor_queue, file_send_queue, processed_frags, poisoned_segments,
+                 bootstrap_publisher, split_strategy="split", large_file=None):
         Thread.__init__(self)
         self.file_processor_queue = file_processor_queue
         self.file_send_queue = file_send_queue
     
         self.go = True
         self.processed_frags = processed_frags
+        self.poisoned_segments = poisoned_segments
+        self.bootstrap_publisher = bootstrap_publisher
+        self.split_strategy = split_strategy
+        self.large_file = large_file
         
     def stop(self):
         self.go = False
@@ -145,77 +672,432 @@ class FileProcessor(Thread):
                 
                 if extension == ".f4x":
                     # Split .f4x files into fragments
+                    self.process_segment(event)
                     
-                    f4x_filename = event
-                    
-                    try:
-                        splitter = hds_seg_fragmenter.HDSSegSplitter(f4x_filename)
-                        for fragment in splitter.split():
-                            # currently refragments previously fragmented fragments
-                            remote_filename = "{stream_name}Seg{segment_number}-Frag{fragment_number}".format(stream_name=splitter.stream_name,
-                                                                                                            segment_number=fragment.segment_number,
-                                                                                                            fragment_number=fragment.number)
-                            # skip if seen before
-                            if remote_filename in self.processed_frags:
-                                log.debug("Skipping previously processed fragment: %s", remote_filename)
-                                continue
-                            
-                            payload = fragment.data
-                            tf = TransferFile(create_time=datetime.now(),
-                                          remote_filename=remote_filename,
-                                          payload=payload,
-                                          content_type="video/f4f")
-                        
-                            log.debug("Adding %s to send queue", remote_filename)
-                            self.file_send_queue.put(tf)
-                            log.debug("Adding %s to processed_frags", remote_filename)
-                            self.processed_frags.append(remote_filename)
-                            
-                    except HDSSegSplitterException as e:
-                        log.warn("Problem while processing %s: %s", event, e)
+                elif extension == ".bootstrap":
+                    # no need to wait: incomplete bootstraps fail to parse
+                    tf = read_bootstrap_transfer_file(event, self.bootstrap_publisher)
                     
-                elif extension in [".bootstrap", ".f4m"]:
-                    payload = open(event, "rb").read()
-                    remote_filename = os.path.basename(event)
+                    if tf:
+                        log.debug("Adding %s to send queue", tf.remote_filename)
+                        self.file_send_queue.put(tf)
                     
-                    mime_types = {".bootstrap": "application/binary",
-                                  ".f4m":       "application/f4m"}
-                    
-                    tf = TransferFile(create_time=datetime.now(),
-                                      remote_filename=remote_filename,
-                                      payload=payload,
-                                      content_type=mime_types[extension])
+                elif extension in MIME_TYPES:
+                    tf = read_transfer_file(event)
                     
                     log.debug("Sleeping a bit")
-                    time.sleep(3)
-                    log.debug("Adding %s to send queue", remote_filename)
+                    time.sleep(MANIFEST_SETTLE_SECONDS)
+                    log.debug("Adding %s to send queue", tf.remote_filename)
                     self.file_send_queue.put(tf)
                     
                 else:
                     log.debug("No action defined for: %s", event)
+    
+    def process_segment(self, f4x_filename):
+        """ Splits a segment and adds its new fragments to file_send_queue """
+        
+        splitter = None
+        signature = None
+        
+        try:
+            splitter = hds_seg_fragmenter.HDSSegSplitter(f4x_filename, large_file=self.large_file)
+            # before splitting, as the packager may append while the split runs
+            signature = self.poisoned_segments.signature(splitter)
+            
+            if self.poisoned_segments.is_poisoned(splitter, signature):
+                log.debug("Skipping unchanged poisoned segment: %s", f4x_filename)
+                return
+            
+            for fragment in getattr(splitter, self.split_strategy)(verify=True):
+                # currently refragments previously fragmented fragments
+                remote_filename = fragment_remote_filename(splitter.stream_name, fragment)
+                # skip if seen before
+                if remote_filename in self.processed_frags:
+                    log.debug("Skipping previously processed fragment: %s", remote_filename)
+                    continue
+                
+                payload = fragment.data
+                tf = TransferFile(create_time=datetime.now(),
+                              remote_filename=remote_filename,
+                              payload=payload,
+                              content_type="video/f4f",
+                              digest=fragment.digest,
+                              live_edge_fragment=None)
+            
+                log.debug("Adding %s to send queue", remote_filename)
+                self.file_send_queue.put(tf)
+                log.debug("Adding %s to processed_frags", remote_filename)
+                self.processed_frags.append(remote_filename)
+            
+            if splitter.quarantined:
+                reasons = "; ".join(q.reason for q in splitter.quarantined)
+                self.poisoned_segments.poison(splitter, signature, reasons)
+                
+        except HDSSegSplitterException as e:
+            log.warn("Problem while processing %s: %s", f4x_filename, e)
+            
+            if splitter:
+                self.poisoned_segments.poison(splitter, signature, str(e))
+        
+        except (IOError, OSError) as e:
+            # most likely removed while being split
+            log.warn("Problem while reading %s: %s", f4x_filename, e)
+                    
+
+class EventLoopDaemon(object):
+    """ Alternative to the FileProcessor and UploadQueueProcessor threads. 
+    
+    inotify events, split results and upload completions are all handled on
+    one event loop, which sleeps in select() until there is work. Splitting,
+    and parsing and trimming bootstraps, runs in a process pool and uploads
+    are bounded concurrent tasks in a thread pool. stop() drains in-flight
+    work before run() returns """
+    
+    def __init__(self, source_dir, file_adapter_factory, upload_index, base_directory="/",
+                 split_processes=SPLIT_PROCESS_COUNT, upload_concurrency=UPLOAD_CONCURRENCY,
+                 upload_scheduler=None, bootstrap_publisher=None, split_strategy="split", large_file=None,
+                 started=None):
+        self.source_dir = source_dir
+        self.file_adapter_factory = file_adapter_factory
+        self.upload_index = upload_index
+        self.base_directory = base_directory
+        self.split_processes = split_processes
+        self.upload_concurrency = upload_concurrency
+        self.split_strategy = split_strategy
+        self.large_file = large_file
+        # set once files in source_dir are being watched
+        self.started = started or threading.Event()
+        
+        self.go = True
+        self.processed_frags = deque(maxlen=PROCESSED_FRAGMENT_INDEX_LENGTH)
+        self.poisoned_segments = PoisonedSegmentIndex()
+        
+        self.events = Queue.Queue()
+        # an empty UploadScheduler is falsy
+        self.upload_scheduler = upload_scheduler if upload_scheduler is not None else UploadScheduler()
+        self.bootstrap_publisher = bootstrap_publisher or BootstrapPublisher()
+        self.uploads_in_flight = 0
+        self.next_lag_report = time.time() + LAG_REPORT_SECONDS
+        
+        # f4x filename -> (splitter, signature before the split), for segments being split
+        self.splits_in_flight = {}
+        # segments which changed again while being split
+        self.resplit = set()
+        
+        # .bootstraps being prepared, and those which changed again meanwhile
+        self.bootstraps_in_flight = set()
+        self.reprepare = set()
+        
+        # heap of (due time, pathname) for .f4m manifests waiting to settle
+        self.delayed = []
+        self.delayed_pathnames = set()
+        
+        # filled by pool threads, emptied by the loop
+        self._completions = deque()
+        self._adapters = threading.local()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+    
+    def run(self):
+        wm = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(wm, EventHandler(file_queue=self.events))
+        wm.add_watch(self.source_dir, INOTIFY_MASK, rec=False)
+        
+        # fork the split workers before any threads are started
+        self.split_pool = Pool(self.split_processes, initializer=_ignore_sigint)
+        self.upload_pool = ThreadPool(self.upload_concurrency)
+        
+        log.info("Event loop started on %s", self.source_dir)
+        self.started.set()
+        
+        try:
+            while self.go:
+                readable = self._select([wm.get_fd(), self._wakeup_read], self._next_timeout())
+                
+                if wm.get_fd() in readable:
+                    notifier.read_events()
+                    notifier.process_events()
+                
+                self._run_once()
+        finally:
+            log.info("Event loop stopping. Draining in-flight work")
+            notifier.stop()
+            self._drain()
+            
+            self.split_pool.close()
+            self.upload_pool.close()
+            self.split_pool.join()
+            self.upload_pool.join()
+            
+            os.close(self._wakeup_read)
+            os.close(self._wakeup_write)
+            log.info("Event loop stopped")
+    
+    def stop(self):
+        """ Safe to call from a signal handler """
+        self.go = False
+        self._wake()
+    
+    def _drain(self):
+        # no more inotify events, so settling manifests can be sent now
+        self.delayed = [(0, pathname) for _, pathname in self.delayed]
+        
+        while self._has_pending_work():
+            self._run_once()
+            
+            if self._has_pending_work():
+                # woken by completions. Held bootstraps are due by _next_timeout()
+                self._select([self._wakeup_read], self._next_timeout())
+    
+    def _has_pending_work(self):
+        return not self.events.empty() or self.delayed or self.splits_in_flight or self.bootstraps_in_flight or \
+            not self.upload_scheduler.empty() or self.uploads_in_flight
+    
+    def _run_once(self):
+        self._handle_completions()
+        self._handle_events()
+        self._handle_due_manifests()
+        self._dispatch_uploads()
+        
+        if time.time() >= self.next_lag_report:
+            log_live_edge_lags(self.upload_scheduler)
+            self.next_lag_report = time.time() + LAG_REPORT_SECONDS
+    
+    def _select(self, fds, timeout):
+        try:
+            readable = select.select(fds, [], [], timeout)[0]
+        except select.error as e:
+            # interrupted by a signal, e.g. stop()
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+        
+        if self._wakeup_read in readable:
+            os.read(self._wakeup_read, 4096)
+        
+        return readable
+    
+    def _next_timeout(self):
+        next_due = self.next_lag_report
+        if self.delayed:
+            next_due = min(next_due, self.delayed[0][0])
+        
+        bootstrap_release_time = self.upload_scheduler.next_release_time()
+        if bootstrap_release_time is not None:
+            next_due = min(next_due, bootstrap_release_time)
+        
+        return max(0, next_due - time.time())
+    
+    def _wake(self):
+        try:
+            os.write(self._wakeup_write, "x")
+        except OSError:
+            # pipe already closed after shutdown
+            pass
+    
+    def _complete(self, completion):
+        """ Pool callback. Runs on a pool thread so only queues the result """
+        self._completions.append(completion)
+        self._wake()
+    
+    def _handle_events(self):
+        while True:
+            try:
+                pathname = self.events.get_nowait()
+            except Empty:
+                return
+            
+            extension = os.path.splitext(pathname)[1].lower()
+            
+            if extension == ".f4x":
+                self._submit_split(pathname)
+            elif extension == ".bootstrap":
+                self._submit_bootstrap(pathname)
+            elif extension in MIME_TYPES:
+                if pathname not in self.delayed_pathnames:
+                    self.delayed_pathnames.add(pathname)
+                    heapq.heappush(self.delayed, (time.time() + MANIFEST_SETTLE_SECONDS, pathname))
+            else:
+                log.debug("No action defined for: %s", pathname)
+    
+    def _submit_split(self, f4x_filename):
+        if f4x_filename in self.splits_in_flight:
+            # split again once the current split finishes, rather than in parallel
+            self.resplit.add(f4x_filename)
+            return
+        
+        try:
+            splitter = hds_seg_fragmenter.HDSSegSplitter(f4x_filename)
+        except HDSSegSplitterException as e:
+            log.warn("Problem while processing %s: %s", f4x_filename, e)
+            return
+        
+        # before splitting, as the packager may append while the split runs
+        signature = self.poisoned_segments.signature(splitter)
+        
+        if self.poisoned_segments.is_poisoned(splitter, signature):
+            log.debug("Skipping unchanged poisoned segment: %s", f4x_filename)
+            return
+        
+        # fragment names of this segment start with the .f4x's basename
+        fragment_prefix = os.path.splitext(os.path.basename(f4x_filename))[0] + "-Frag"
+        processed_frags = [remote_filename for remote_filename in self.processed_frags
+                           if remote_filename.startswith(fragment_prefix)]
+        
+        log.debug("Submitting %s for splitting", f4x_filename)
+        self.splits_in_flight[f4x_filename] = (splitter, signature)
+        self.split_pool.apply_async(split_segment, (f4x_filename, self.split_strategy, self.large_file,
+                                                    processed_frags),
+                                    callback=lambda result: self._complete(("split", result)))
+    
+    def _submit_bootstrap(self, pathname):
+        if pathname in self.bootstraps_in_flight:
+            # packagers write bootstraps in several events. Only the last state matters
+            self.reprepare.add(pathname)
+            return
+        
+        self.bootstraps_in_flight.add(pathname)
+        self.split_pool.apply_async(prepare_bootstrap_file, (pathname, self.bootstrap_publisher.dvr_window),
+                                    callback=lambda result: self._complete(("bootstrap", result)))
+    
+    def _handle_completions(self):
+        while self._completions:
+            kind, result = self._completions.popleft()
+            
+            if kind == "upload":
+                self.uploads_in_flight -= 1
+                self.upload_scheduler.task_done(result)
+            elif kind == "bootstrap":
+                self._handle_bootstrap_result(result)
+            else:
+                self._handle_split_result(result)
+    
+    def _handle_split_result(self, result):
+        splitter, signature = self.splits_in_flight.pop(result.f4x_filename)
+        
+        # a segment which changed during the split isn't poisoned by the old signature
+        if result.error:
+            log.warn("Problem while processing %s: %s", result.f4x_filename, result.error)
+            self.poisoned_segments.poison(splitter, signature, result.error)
+        elif result.quarantine_reasons:
+            self.poisoned_segments.poison(splitter, signature, "; ".join(result.quarantine_reasons))
+        
+        for fragment in result.fragments:
+            remote_filename = fragment_remote_filename(result.stream_name, fragment)
+            
+            if remote_filename in self.processed_frags:
+                log.debug("Skipping previously processed fragment: %s", remote_filename)
+                continue
+            
+            self.upload_scheduler.put(TransferFile(create_time=datetime.now(),
+                                                  remote_filename=remote_filename,
+                                                  payload=fragment.data,
+                                                  content_type="video/f4f",
+                                                  digest=fragment.digest,
+                                                  live_edge_fragment=None))
+            self.processed_frags.append(remote_filename)
+        
+        if result.f4x_filename in self.resplit:
+            self.resplit.discard(result.f4x_filename)
+            self._submit_split(result.f4x_filename)
+    
+    def _handle_bootstrap_result(self, result):
+        self.bootstraps_in_flight.discard(result.pathname)
+        
+        if result.transfer_file is None:
+            log.warn("Problem while reading %s: %s", result.pathname, result.error)
+        elif result.prepared_bootstrap is None:
+            # another event follows once the packager finishes writing
+            log.debug("Not publishing %s yet: %s", result.pathname, result.error)
+        elif self.bootstrap_publisher.should_publish(result.pathname, result.prepared_bootstrap):
+            self.upload_scheduler.put(publishable_transfer_file(result.transfer_file, result.prepared_bootstrap))
+        else:
+            log.debug("Skipping bootstrap without a new live edge: %s", result.transfer_file.remote_filename)
+        
+        if result.pathname in self.reprepare:
+            self.reprepare.discard(result.pathname)
+            self._submit_bootstrap(result.pathname)
+    
+    def _handle_due_manifests(self):
+        while self.delayed and self.delayed[0][0] <= time.time():
+            _, pathname = heapq.heappop(self.delayed)
+            self.delayed_pathnames.discard(pathname)
+            
+            try:
+                self.upload_scheduler.put(read_transfer_file(pathname))
+            except IOError as e:
+                log.warn("Problem while reading %s: %s", pathname, e)
+    
+    def _dispatch_uploads(self):
+        while self.uploads_in_flight < self.upload_concurrency:
+            try:
+                tf = self.upload_scheduler.get_nowait()
+            except Empty:
+                break
+            
+            self.uploads_in_flight += 1
+            self.upload_pool.apply_async(self._upload, (tf,),
+                                         callback=lambda uploaded, tf=tf: self._complete(("upload", tf)))
+    
+    def _upload(self, tf):
+        """ Runs on an upload pool thread. Each thread has its own adapter """
+        
+        # apply_async has no error callback, so nothing may raise from here
+        try:
+            file_adapter = getattr(self._adapters, "file_adapter", None)
+            if file_adapter is None:
+                file_adapter = self._adapters.file_adapter = self.file_adapter_factory()
+            
+            return upload_transfer_file(file_adapter, self.upload_index, self.base_directory, tf)
+        except Exception:
+            log.exception("Upload of %s failed", tf.remote_filename)
+            return False
                     
 
 class S3HDSAutoUploader(object):
     
-    def main(self):
-        self._parse_args()
+    def __init__(self, file_adapter_factory=None):
+        """ file_adapter_factory, if given, returns the upload adapter for
+        each uploader instead of S3 or the local store. Used by load tests """
+        self.file_adapter_factory = file_adapter_factory
+        self.stopping = threading.Event()
+        # set once files in the source directory are being watched
+        self.started = threading.Event()
+        self.daemon = None
+        self.threads = []
+    
+    def main(self, argv=None):
+        self.configure(argv)
+        
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: self.stop())
+        
+        self.run()
+    
+    def configure(self, argv=None):
+        """ Parses the command line, or argv, and sets up logging """
+        self._parse_args(argv)
         self._setup_logging()
+    
+    def run(self):
+        """ Runs until stop() is called """
         
-        self.file_send_queue = Queue.Queue()
+        if self.args.event_loop:
+            self._run_event_loop()
+            return
+        
+        self.file_send_queue = UploadScheduler(prioritise=not self.args.fifo)
         self.file_processor_queue = Queue.Queue()
-    
-        self.threads = []
         
         self._start_threads()
         #self.add_existing_files_to_queue()
+        self.started.set()
         
-        try:
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            self.stop()
+        while not self.stopping.wait(LAG_REPORT_SECONDS):
+            log_live_edge_lags(self.file_send_queue)
+        
+        self._stop_threads()
             
-    def _parse_args(self):
+    def _parse_args(self, argv=None):
         import argparse
     
         parser = argparse.ArgumentParser(description='Automatically turn f4f into HDS fragments and send them to S3')
@@ -237,19 +1119,58 @@ class S3HDSAutoUploader(object):
                             default=False,
                             help="Quite mode (WARNING)")
         
-        parser.add_argument('-b', "--bucket", dest="destination bucket",
-                            required=True,
+        destination = parser.add_mutually_exclusive_group(required=self.file_adapter_factory is None)
+        
+        destination.add_argument('-b', "--bucket", dest="bucket",
                             help="AWS bucket name")
         
+        destination.add_argument('-l', "--local-store", dest="local_store_dir",
+                            help="Store objects in this directory instead of S3 (for offline use)")
+        
+        parser.add_argument('-i', "--index", dest="index_filename",
+                            default=None,
+                            help="Upload digest index. Objects whose content is unchanged are not re-uploaded, across restarts")
+        
         parser.add_argument('-a', "--access-key", dest="access_key",
                             default=None, required=False,
                             help="AWS Access Key. (default: Uses boto initialisation: http://boto.readthedocs.org/en/latest/boto_config_tut.html")
             
-        parser.add_argument('-s', "--secret", dest="secret",
+        parser.add_argument('-S', "--secret", dest="secret",
                             default=None, required=False,
                             help="AWS Secret. (default: Uses boto initialisation: http://boto.readthedocs.org/en/latest/boto_config_tut.html")
 
-        self.args = parser.parse_args()
+        parser.add_argument('-e', "--event-loop", dest="event_loop", action="store_true",
+                            default=False,
+                            help="Run on a single event loop, with a split process pool and bounded uploads, instead of worker threads")
+
+        parser.add_argument("--fifo", dest="fifo", action="store_true",
+                            default=False,
+                            help="Upload in arrival order rather than live edge first. .bootstrap files are still held "
+                                 "until the fragment they advertise has been uploaded")
+
+        parser.add_argument("--dvr-window", dest="dvr_window", type=float, metavar="SECONDS",
+                            default=None,
+                            help="Trim published bootstraps to the last SECONDS of fragments (default: keep all)")
+
+        parser.add_argument("--split-strategy", dest="split_strategy", choices=SPLIT_STRATEGIES,
+                            default="split",
+                            help="Split segments by seeking to each fragment or by reading the f4f once (default: %(default)s)")
+
+        parser.add_argument("--large-file", dest="large_file", action="store_true",
+                            default=None,
+                            help="Read f4f files with plain seeks and reads (default: only for f4f files over 4GB)")
+
+        parser.add_argument("--split-workers", dest="split_workers", type=int,
+                            default=None,
+                            help="Splitting threads, or processes with -e (default: %d, or %d with -e)" % 
+                                (FILE_PROCESSOR_THREAD_COUNT, SPLIT_PROCESS_COUNT))
+
+        parser.add_argument("--upload-workers", dest="upload_workers", type=int,
+                            default=None,
+                            help="Upload threads, or concurrent uploads with -e (default: %d, or %d with -e)" % 
+                                (S3_UPLOADER_THREAD_COUNT, UPLOAD_CONCURRENCY))
+
+        self.args = parser.parse_args(argv)
             
     def _setup_logging(self):
         if self.args.debug:
@@ -265,24 +1186,31 @@ class S3HDSAutoUploader(object):
    
     def _start_threads(self):
         processed_frags = deque(maxlen=PROCESSED_FRAGMENT_INDEX_LENGTH)
+        poisoned_segments = PoisonedSegmentIndex()
+        bootstrap_publisher = BootstrapPublisher(dvr_window=self.args.dvr_window)
         # File / fragment processor
-        for _ in xrange(FILE_PROCESSOR_THREAD_COUNT):
+        for _ in xrange(self.args.split_workers or FILE_PROCESSOR_THREAD_COUNT):
             file_processor = FileProcessor(self.file_processor_queue,
                                            self.file_send_queue,
-                                           processed_frags=processed_frags)
+                                           processed_frags=processed_frags,
+                                           poisoned_segments=poisoned_segments,
+                                           bootstrap_publisher=bootstrap_publisher,
+                                           split_strategy=self.args.split_strategy,
+                                           large_file=self.args.large_file)
             self.log.info("Starting File Processor Thread")
             file_processor.start()
             self.threads.append(file_processor)
             
+        upload_index = FragmentIndex(self.args.index_filename, maxlen=UPLOAD_INDEX_LENGTH)
+        
         # S3 Uploader
-        for _ in xrange(S3_UPLOADER_THREAD_COUNT):
-            s3_adapter = S3UploadAdapter(bucket_name=self.args.bucket, 
-                                         access_key=self.args.access_key,
-                                         secret=self.args.secret)
+        for _ in xrange(self.args.upload_workers or S3_UPLOADER_THREAD_COUNT):
+            s3_adapter = self._create_file_adapter()
             
             s3_uploader = UploadQueueProcessor(base_directory="/",
                                                file_send_queue=self.file_send_queue,
-                                               file_adapter=s3_adapter) 
+                                               file_adapter=s3_adapter,
+                                               upload_index=upload_index) 
                                                  
             self.log.info("Starting S3 Uploader Thread")
             s3_uploader.start()
@@ -290,18 +1218,54 @@ class S3HDSAutoUploader(object):
             
             
         wm = pyinotify.WatchManager()  # Watch Manager
-        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MODIFY # watched events
         notifier = pyinotify.ThreadedNotifier(wm, EventHandler(file_queue=self.file_processor_queue))
-        wm.add_watch(self.args.source_dir, mask, rec=False)
+        wm.add_watch(self.args.source_dir, INOTIFY_MASK, rec=False)
         self.log.info("Starting inotify thread")
         notifier.start()
         self.threads.append(notifier)
         
-    def stop(self):
+    def _stop_threads(self):
         for mthread in self.threads:
             self.log.debug("Stopping %s", mthread)
             mthread.stop()
-        sys.exit(1)
+        
+        for mthread in self.threads:
+            mthread.join()
+        
+    def _run_event_loop(self):
+        self.daemon = EventLoopDaemon(source_dir=self.args.source_dir,
+                                      file_adapter_factory=self._create_file_adapter,
+                                      upload_index=FragmentIndex(self.args.index_filename, maxlen=UPLOAD_INDEX_LENGTH),
+                                      split_processes=self.args.split_workers or SPLIT_PROCESS_COUNT,
+                                      upload_concurrency=self.args.upload_workers or UPLOAD_CONCURRENCY,
+                                      upload_scheduler=UploadScheduler(prioritise=not self.args.fifo),
+                                      bootstrap_publisher=BootstrapPublisher(dvr_window=self.args.dvr_window),
+                                      split_strategy=self.args.split_strategy,
+                                      large_file=self.args.large_file,
+                                      started=self.started)
+        
+        if self.stopping.is_set():
+            return
+        
+        self.daemon.run()
+        
+    def _create_file_adapter(self):
+        if self.file_adapter_factory:
+            return self.file_adapter_factory()
+        
+        if self.args.local_store_dir:
+            return LocalObjectStoreAdapter(self.args.local_store_dir)
+        
+        return S3UploadAdapter(bucket_name=self.args.bucket, 
+                               access_key=self.args.access_key,
+                               secret=self.args.secret)
+        
+    def stop(self):
+        """ Safe to call from a signal handler or another thread """
+        self.stopping.set()
+        
+        if self.daemon:
+            self.daemon.stop()
 
                             
     def add_existing_files_to_queue(self):
@@ -0,0 +1,255 @@
+""" Compares consecutive .bootstrap files of a live stream.
+
+Packagers rewrite the bootstrap far more often than its content changes. The
+segment and fragment run tables of each rewrite are compared with the last
+published one, so that it is only published when the live edge has moved
+forward or the run tables have really changed. The DVR window can
+optionally be trimmed before publishing.
+
+@author: Alastair McCormack
+@license: MIT License
+
+"""
+
+import bitstring
+import copy
+import logging
+from collections import namedtuple
+from threading import Lock
+from f4v import F4VParser, F4VParserException, BootStrapInfoBox
+from f4v_writer import F4VWriter, to_timescale, from_timescale
+
+class NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+log = logging.getLogger(__name__)
+log.addHandler(NullHandler())
+log.setLevel(logging.FATAL)
+
+LiveEdge = namedtuple("LiveEdge", ["segment_number", "fragment_number"])
+BootstrapDiff = namedtuple("BootstrapDiff", ["changed", "live_edge_moved", "live_edge_moved_back",
+                                             "live_edge", "previous_live_edge",
+                                             "added_segment_runs", "removed_segment_runs",
+                                             "added_fragment_runs", "removed_fragment_runs"])
+# What diff_bootstraps compares, as plain tuples so that it can be pickled
+BootstrapSnapshot = namedtuple("BootstrapSnapshot", ["live_edge", "segment_runs", "fragment_runs", "header_fields"])
+# payload is the bootstrap as written, publish_payload as it is to be published
+PreparedBootstrap = namedtuple("PreparedBootstrap", ["payload", "publish_payload", "snapshot"])
+
+class BootstrapDiffException(Exception):
+    pass
+
+def parse_bootstrap(data):
+    """ Returns the BootStrapInfoBox of a .bootstrap payload """
+
+    f4v_parser = F4VParser()
+    bs = bitstring.ConstBitStream(bytes=data)
+
+    try:
+        header = f4v_parser._read_box_header(bs)
+        if header.box_type != BootStrapInfoBox.type:
+            raise BootstrapDiffException("Expected abst, found %s" % header.box_type)
+        return f4v_parser._parse_abst(bs, header)
+    except (bitstring.Error, ValueError, F4VParserException) as e:
+        # most likely caught mid-write
+        raise BootstrapDiffException("Incomplete or corrupt bootstrap: %s" % e)
+
+def live_edge(abst):
+    """ Returns the LiveEdge of a bootstrap: the newest complete fragment
+    according to its last fragment run and current media time """
+
+    if not abst.fragment_tables:
+        return None
+
+    afrt = abst.fragment_tables[-1]
+    runs = [frte for frte in afrt.fragments if frte.fragment_duration]
+    if not runs:
+        return None
+
+    last_run = runs[-1]
+    run_start = to_timescale(last_run.first_fragment_timestamp, afrt.time_scale)
+    current_media_time = to_timescale(abst.current_media_time, afrt.time_scale)
+    fragment_count = max(1, (current_media_time - run_start) // last_run.fragment_duration)
+
+    segment_number = None
+    if abst.segment_run_tables and abst.segment_run_tables[-1].segment_run_table_entries:
+        segment_number = abst.segment_run_tables[-1].segment_run_table_entries[-1].first_segment
+
+    return LiveEdge(segment_number=segment_number, fragment_number=last_run.first_fragment + fragment_count - 1)
+
+def snapshot_bootstrap(abst):
+    """ Returns the BootstrapSnapshot of a BootStrapInfoBox """
+
+    return BootstrapSnapshot(live_edge=live_edge(abst), segment_runs=_segment_runs(abst),
+                             fragment_runs=_fragment_runs(abst), header_fields=_header_fields(abst))
+
+def diff_bootstraps(previous_snapshot, snapshot):
+    """ Compares two BootstrapSnapshots run by run. live_edge_moved is only
+    set when the live edge has moved forward """
+
+    previous_segment_runs = previous_snapshot.segment_runs
+    segment_runs = snapshot.segment_runs
+    previous_fragment_runs = previous_snapshot.fragment_runs
+    fragment_runs = snapshot.fragment_runs
+
+    added_segment_runs = _missing_from(segment_runs, previous_segment_runs)
+    removed_segment_runs = _missing_from(previous_segment_runs, segment_runs)
+    added_fragment_runs = _missing_from(fragment_runs, previous_fragment_runs)
+    removed_fragment_runs = _missing_from(previous_fragment_runs, fragment_runs)
+
+    changed = bool(added_segment_runs or removed_segment_runs or added_fragment_runs or removed_fragment_runs) or \
+        previous_snapshot.header_fields != snapshot.header_fields
+
+    previous_edge = previous_snapshot.live_edge
+    edge = snapshot.live_edge
+
+    return BootstrapDiff(changed=changed, live_edge_moved=_is_ahead(edge, previous_edge),
+                         live_edge_moved_back=_is_ahead(previous_edge, edge),
+                         live_edge=edge, previous_live_edge=previous_edge,
+                         added_segment_runs=added_segment_runs, removed_segment_runs=removed_segment_runs,
+                         added_fragment_runs=added_fragment_runs, removed_fragment_runs=removed_fragment_runs)
+
+def trim_dvr_window(abst, window_seconds):
+    """ Returns a copy of abst whose fragment runs start no more than
+    window_seconds before the current media time. Segment runs are left
+    alone, as clients map fragments to segments with them """
+
+    trimmed_abst = copy.deepcopy(abst)
+
+    for afrt in trimmed_abst.fragment_tables:
+        current_media_time = to_timescale(abst.current_media_time, afrt.time_scale)
+        window_start = current_media_time - int(window_seconds * afrt.time_scale)
+        trimmed_runs = []
+
+        for index, frte in enumerate(afrt.fragments):
+            if not frte.fragment_duration:
+                # discontinuities only matter between the runs which are kept
+                if trimmed_runs:
+                    trimmed_runs.append(frte)
+                continue
+
+            run_start = to_timescale(frte.first_fragment_timestamp, afrt.time_scale)
+            run_end = current_media_time
+            for next_frte in afrt.fragments[index + 1:]:
+                if next_frte.fragment_duration:
+                    run_end = to_timescale(next_frte.first_fragment_timestamp, afrt.time_scale)
+                    break
+
+            if run_end <= window_start:
+                continue
+
+            if run_start < window_start:
+                # start the run at the first fragment inside the window
+                skipped_fragments = (window_start - run_start) // frte.fragment_duration
+                run_start += skipped_fragments * frte.fragment_duration
+                frte = frte._replace(first_fragment=frte.first_fragment + skipped_fragments,
+                                     first_fragment_timestamp=from_timescale(run_start, afrt.time_scale))
+
+            trimmed_runs.append(frte)
+
+        afrt.fragments = trimmed_runs
+
+    return trimmed_abst
+
+def prepare_bootstrap(payload, dvr_window=None):
+    """ Parses a .bootstrap payload and trims it to dvr_window seconds, if
+    given. Returns a PreparedBootstrap. Needs no shared state, so it can run
+    in a worker process. Raises BootstrapDiffException for incomplete
+    bootstraps """
+
+    abst = parse_bootstrap(payload)
+
+    publish_payload = payload
+    if dvr_window:
+        publish_payload = F4VWriter().abst(trim_dvr_window(abst, dvr_window))
+
+    return PreparedBootstrap(payload=payload, publish_payload=publish_payload, snapshot=snapshot_bootstrap(abst))
+
+def _is_ahead(edge, other_edge):
+    """ True if LiveEdge edge is a later fragment than other_edge. An
+    unknown edge is behind any known one """
+    if edge is None:
+        return False
+    return other_edge is None or edge.fragment_number > other_edge.fragment_number
+
+def _segment_runs(abst):
+    return [(index, tuple(entry)) for index, asrt in enumerate(abst.segment_run_tables)
+            for entry in asrt.segment_run_table_entries]
+
+def _fragment_runs(abst):
+    return [(index, tuple(entry)) for index, afrt in enumerate(abst.fragment_tables)
+            for entry in afrt.fragments]
+
+def _missing_from(runs, other_runs):
+    """ Runs which aren't in other_runs, in order. DVR windows hold thousands
+    of runs, so membership is checked against a set """
+    other_runs = set(other_runs)
+    return [run for run in runs if run not in other_runs]
+
+def _header_fields(abst):
+    return (abst.profile_raw, abst.live, abst.time_scale, abst.movie_identifier, abst.server_entry_table,
+            abst.quality_entry_table, abst.drm_data, abst.meta_data)
+
+
+class BootstrapPublisher(object):
+    """ Decides whether a rewritten .bootstrap should be published. Remembers
+    the last published bootstrap per filename and is safe to share between
+    threads. Bootstraps are parsed outside the lock, so streams don't wait
+    on each other """
+
+    def __init__(self, dvr_window=None):
+        self.dvr_window = dvr_window
+        self._published = {}
+        self._lock = Lock()
+
+    def publishable_bootstrap(self, filename, payload):
+        """ Returns the PreparedBootstrap to publish, or None if publishing
+        would be pointless. Raises BootstrapDiffException for incomplete
+        bootstraps """
+
+        if self._is_published_payload(filename, payload):
+            log.debug("%s rewritten with identical bytes", filename)
+            return None
+
+        prepared_bootstrap = prepare_bootstrap(payload, self.dvr_window)
+
+        if not self.should_publish(filename, prepared_bootstrap):
+            return None
+
+        return prepared_bootstrap
+
+    def should_publish(self, filename, prepared_bootstrap):
+        """ Compares a PreparedBootstrap with the last one published and, if
+        it should be published, remembers it instead. A bootstrap whose live
+        edge is behind the published one, e.g. read late by another thread,
+        is never published """
+
+        with self._lock:
+            previous_payload, previous_snapshot = self._published.get(filename, (None, None))
+
+            if prepared_bootstrap.payload == previous_payload:
+                log.debug("%s rewritten with identical bytes", filename)
+                return False
+
+            if previous_snapshot is not None:
+                bootstrap_diff = diff_bootstraps(previous_snapshot, prepared_bootstrap.snapshot)
+
+                if bootstrap_diff.live_edge_moved_back:
+                    log.debug("%s is older than the published one (%s, not %s)", filename, bootstrap_diff.live_edge,
+                              bootstrap_diff.previous_live_edge)
+                    return False
+
+                if not bootstrap_diff.changed and not bootstrap_diff.live_edge_moved:
+                    log.debug("%s rewritten without moving the live edge (%s)", filename, bootstrap_diff.live_edge)
+                    return False
+
+                log.debug("%s live edge moved from %s to %s", filename, bootstrap_diff.previous_live_edge,
+                          bootstrap_diff.live_edge)
+
+            self._published[filename] = (prepared_bootstrap.payload, prepared_bootstrap.snapshot)
+            return True
+
+    def _is_published_payload(self, filename, payload):
+        with self._lock:
+            return self._published.get(filename, (None, None))[0] == payload
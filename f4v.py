@@ -10,6 +10,9 @@ import bitstring
 from datetime import datetime
 from collections import namedtuple
 import logging
+import os
+import struct
+from timeit import default_timer
 
 class NullHandler(logging.Handler):
     def emit(self, record):
@@ -92,43 +95,263 @@ class MediaDataBox(MixinDictRepr):
     type = "mdat"
 
 BoxHeader = namedtuple( "BoxHeader", ["box_size", "box_type", "header_size"] )
+
+# Files above this size need 64-bit box sizes and afra offsets
+LARGE_FILE_SIZE = 0xFFFFFFFF
+
+class F4VParserException(Exception):
+    pass
  
     
+class ParseTracer(object):
+    """ Receives timings from F4VParser. Override the methods of interest.
+    Durations are in seconds """
+    
+    def file_opened(self, filename, duration):
+        pass
+    
+    def box_parsed(self, box_type, byte_size, duration, entry_count):
+        """ Called once per top level box. entry_count is the number of afra
+        entries or abst run table entries """
+        pass
+    
+    def bytes_read(self, filename, byte_size, duration):
+        """ Called for raw reads which bypass box parsing """
+        pass
+    
+    def header_scanned(self, filename, header_size, duration):
+        """ Called for each box header read by scan_headers """
+        pass
+
+class ProfilingTracer(ParseTracer):
+    """ Totals the cost of parsing per box type """
+    
+    OPEN = "<open>"
+    READ = "<read>"
+    SCAN = "<scan>"
+    
+    BoxTypeCost = namedtuple("BoxTypeCost", ["box_type", "count", "byte_size", "duration", "entry_count"])
+    
+    def __init__(self):
+        self.costs = {}
+    
+    def file_opened(self, filename, duration):
+        self._add(self.OPEN, 0, duration, 0)
+    
+    def box_parsed(self, box_type, byte_size, duration, entry_count):
+        self._add(box_type, byte_size, duration, entry_count)
+    
+    def bytes_read(self, filename, byte_size, duration):
+        self._add(self.READ, byte_size, duration, 0)
+    
+    def header_scanned(self, filename, header_size, duration):
+        self._add(self.SCAN, header_size, duration, 0)
+    
+    def _add(self, box_type, byte_size, duration, entry_count):
+        cost = self.costs.get(box_type) or self.BoxTypeCost(box_type, 0, 0, 0.0, 0)
+        self.costs[box_type] = self.BoxTypeCost(box_type=box_type, 
+                                                count=cost.count + 1,
+                                                byte_size=cost.byte_size + byte_size,
+                                                duration=cost.duration + duration,
+                                                entry_count=cost.entry_count + entry_count)
+    
+    def report(self):
+        """ Returns the cost breakdown as a table, most expensive first """
+        total_duration = sum(cost.duration for cost in self.costs.values()) or 1.0
+        
+        lines = ["{0:<8} {1:>8} {2:>14} {3:>10} {4:>7} {5:>10}".format("box", "count", "bytes", "seconds", "%", "entries")]
+        for cost in sorted(self.costs.values(), key=lambda c: c.duration, reverse=True):
+            lines.append("{0:<8} {1:>8d} {2:>14d} {3:>10.4f} {4:>6.1f}% {5:>10d}".format(
+                            cost.box_type, cost.count, cost.byte_size, cost.duration,
+                            cost.duration * 100 / total_duration, cost.entry_count))
+        return "\n".join(lines)
+    
+    
 class F4VParser(object):
     
+    def __init__(self, tracer=None, large_file=False):
+        """ With large_file, files are parsed with plain seeks and reads
+        instead of being mapped into a bitstring. This is always done for
+        files larger than LARGE_FILE_SIZE """
+        self.tracer = tracer
+        self.large_file = large_file
+    
     def parse(self, filename=None, bytes_input=None, offset_bytes=0):
         
+        if filename and (self.large_file or os.path.getsize(filename) > LARGE_FILE_SIZE):
+            for box in self._parse_large_file(filename, offset_bytes):
+                yield box
+            return
+        
+        tracer = self.tracer
+        if tracer is not None:
+            open_start = default_timer()
+        
         if filename:
             bs = bitstring.ConstBitStream(filename=filename, offset=offset_bytes * 8)
         else:
             bs = bitstring.ConstBitStream(bytes=bytes_input, offset=offset_bytes * 8)
         
-        log.debug("Starting parse")
-        log.debug("Size is %d bits", bs.len)
+        if tracer is not None:
+            tracer.file_opened(filename, default_timer() - open_start)
+        
+        # checked once, rather than formatting log arguments for every box 
+        debug = log.isEnabledFor(logging.DEBUG)
+        
+        if debug:
+            log.debug("Starting parse")
+            log.debug("Size is %d bits", bs.len)
         
         while bs.pos < bs.len:
-            log.debug("Byte pos before header: %d relative to (%d)", bs.bytepos, offset_bytes)
-            log.debug("Reading header")
+            if tracer is not None:
+                box_start = default_timer()
+            
+            if debug:
+                log.debug("Byte pos before header: %d relative to (%d)", bs.bytepos, offset_bytes)
+                log.debug("Reading header")
             header = self._read_box_header(bs)
             
-            log.debug("Header type: %s", header.box_type)
-            log.debug("Byte pos after header: %d relative to (%d)", bs.bytepos, offset_bytes)
+            if debug:
+                log.debug("Header type: %s", header.box_type)
+                log.debug("Byte pos after header: %d relative to (%d)", bs.bytepos, offset_bytes)
             
             if header.box_type == BootStrapInfoBox.type:
-                log.debug("BootStrapInfoBox found")
-                yield self._parse_abst(bs, header)
+                if debug:
+                    log.debug("BootStrapInfoBox found")
+                box = self._parse_abst(bs, header)
             elif header.box_type == FragmentRandomAccessBox.type:
-                log.debug("FragmentRandomAccessBox found")
-                yield self._parse_afra(bs, header )
+                if debug:
+                    log.debug("FragmentRandomAccessBox found")
+                box = self._parse_afra(bs, header )
             elif header.box_type == MediaDataBox.type:
-                log.debug("MediaDataBox found")
-                yield self._parse_mdat(bs, header)
+                if debug:
+                    log.debug("MediaDataBox found")
+                box = self._parse_mdat(bs, header)
             else:
-                log.debug("Un-implemented / unknown type. Skipping %d bytes" % header.box_size)
-                yield self._parse_unimplemented(bs, header)
+                if debug:
+                    log.debug("Un-implemented / unknown type. Skipping %d bytes", header.box_size)
+                box = self._parse_unimplemented(bs, header)
+            
+            if tracer is not None:
+                tracer.box_parsed(header.box_type, header.header_size + header.box_size, 
+                                  default_timer() - box_start, self._entry_count(box))
+            
+            yield box
+    
+    def _parse_large_file(self, filename, offset_bytes):
+        """ Equivalent of parse() which only holds one box in memory at a time """
+        
+        tracer = self.tracer
+        if tracer is not None:
+            open_start = default_timer()
+        
+        with open(filename, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            file_size = f.tell()
+            f.seek(offset_bytes)
+            
+            if tracer is not None:
+                tracer.file_opened(filename, default_timer() - open_start)
+            
+            offset = offset_bytes
+            while offset < file_size:
+                if tracer is not None:
+                    box_start = default_timer()
                 
+                header = self._read_file_box_header(f)
                 
+                if header.box_type in (BootStrapInfoBox.type, FragmentRandomAccessBox.type, MediaDataBox.type):
+                    payload = f.read(header.box_size)
+                    if len(payload) < header.box_size:
+                        raise F4VParserException("Truncated %s at byte %d" % (header.box_type, offset))
+                    box_bs = bitstring.ConstBitStream(bytes=payload)
                     
+                    if header.box_type == BootStrapInfoBox.type:
+                        box = self._parse_abst(box_bs, header)
+                    elif header.box_type == FragmentRandomAccessBox.type:
+                        box = self._parse_afra(box_bs, header)
+                    else:
+                        box = self._parse_mdat(box_bs, header)
+                else:
+                    box = UnImplementedBox()
+                    box.header = header
+                
+                offset += header.header_size + header.box_size
+                f.seek(offset)
+                
+                if tracer is not None:
+                    tracer.box_parsed(header.box_type, header.header_size + header.box_size, 
+                                      default_timer() - box_start, self._entry_count(box))
+                
+                yield box
+    
+    def _entry_count(self, box):
+        if isinstance(box, FragmentRandomAccessBox):
+            return len(box.local_access_entries) + len(box.global_access_entries)
+        elif isinstance(box, BootStrapInfoBox):
+            return sum(len(asrt.segment_run_table_entries) for asrt in box.segment_run_tables) + \
+                sum(len(afrt.fragments) for afrt in box.fragment_tables)
+        return 0
+                
+                
+                    
+    def scan_headers(self, filename, offset_bytes=0):
+        """ Yields (offset, BoxHeader) tuples for each top level box without
+        reading box payloads. Cheap enough to map the layout of a whole .f4f """
+        
+        tracer = self.tracer
+        if tracer is not None:
+            open_start = default_timer()
+        
+        with open(filename, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            file_size = f.tell()
+            
+            if tracer is not None:
+                tracer.file_opened(filename, default_timer() - open_start)
+            
+            offset = offset_bytes
+            while offset < file_size:
+                if tracer is not None:
+                    header_start = default_timer()
+                
+                f.seek(offset)
+                header = self._read_file_box_header(f)
+                
+                if tracer is not None:
+                    tracer.header_scanned(filename, header.header_size, default_timer() - header_start)
+                
+                yield offset, header
+                offset += header.header_size + header.box_size
+    
+    def _read_file_box_header(self, f):
+        """ Equivalent of _read_box_header for plain file objects """
+        header_start_pos = f.tell()
+        raw_header = f.read(8)
+        if len(raw_header) < 8:
+            raise F4VParserException("Truncated box header at byte %d" % header_start_pos)
+        
+        size, box_type = struct.unpack(">I4s", raw_header)
+        header_size = 8
+        
+        if size == 1:
+            raw_size = f.read(8)
+            if len(raw_size) < 8:
+                raise F4VParserException("Truncated 64-bit box size at byte %d" % header_start_pos)
+            size = struct.unpack(">Q", raw_size)[0]
+            header_size += 8
+        elif size == 0:
+            # box extends to the end of the file
+            size = os.fstat(f.fileno()).st_size - header_start_pos
+        
+        return self._box_header(size, box_type, header_size, header_start_pos)
+    
+    def _box_header(self, size, box_type, header_size, header_start_pos):
+        if size < header_size:
+            raise F4VParserException("Invalid size (%d) of %r box at byte %d" % (size, box_type, header_start_pos))
+        
+        return BoxHeader(box_size=size-header_size, box_type=box_type, header_size=header_size)
+    
     def _read_string(self, bs):
         """ read UTF8 null terminated string """
         result = bs.readto('0x00', bytealigned=True).bytes.decode("utf-8")[:-1]
@@ -151,7 +374,11 @@ class F4VParser(object):
         header_end_pos = bs.bytepos
         header_size = header_end_pos - header_start_pos    
         
-        return BoxHeader(box_size=size-header_size, box_type=box_type, header_size=header_size)
+        if size == 0:
+            # box extends to the end of the stream
+            size = bs.len // 8 - header_start_pos
+        
+        return self._box_header(size, box_type, header_size, header_start_pos)
     
     def _parse_unimplemented(self, bs, header):
         ui = UnImplementedBox()
@@ -246,13 +473,13 @@ class F4VParser(object):
         abst.segment_run_tables = []
         
         segment_count = box_bs.read("uint:8")
-        log.debug("segment_count: %d" % segment_count)
+        log.debug("segment_count: %d", segment_count)
         for _ in xrange(0, segment_count):
             abst.segment_run_tables.append( self._parse_asrt(box_bs) )
 
         abst.fragment_tables = []
         fragment_count = box_bs.read("uint:8")
-        log.debug("fragment_count: %d" % fragment_count)
+        log.debug("fragment_count: %d", fragment_count)
         for _ in xrange(0, fragment_count):
             abst.fragment_tables.append( self._parse_afrt(box_bs) )
         
@@ -0,0 +1,290 @@
+""" F4V box writer. The counterpart of f4v.F4VParser, used to build
+bootstraps and synthetic segments.
+
+@author: Alastair McCormack
+@license: MIT License
+
+"""
+
+import bitstring
+from datetime import datetime, timedelta
+import logging
+import os
+from f4v import FragmentRandomAccessBox, BootStrapInfoBox, SegmentRunTable, FragmentRunTable
+
+class NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+log = logging.getLogger(__name__)
+log.addHandler(NullHandler())
+log.setLevel(logging.FATAL)
+
+EPOCH = datetime.utcfromtimestamp(0)
+
+MAX_UINT16 = 0xFFFF
+MAX_UINT32 = 0xFFFFFFFF
+
+def to_timescale(timestamp, time_scale):
+    """ Converts a parsed datetime back into time_scale units """
+    if timestamp is None:
+        return 0
+    return int(round((timestamp - EPOCH).total_seconds() * time_scale))
+
+def from_timescale(value, time_scale):
+    """ Converts time_scale units into a datetime, as F4VParser does """
+    return EPOCH + timedelta(seconds=value / float(time_scale))
+
+
+class F4VWriter(object):
+
+    def box_header(self, box_type, payload_size, long_size=False):
+        """ Returns the header for a box of payload_size bytes. A 64-bit size is
+        used when asked for or when the box wouldn't fit in 32 bits """
+
+        if long_size or payload_size + 8 > MAX_UINT32:
+            return bitstring.pack("uint:32, bytes:4, uint:64", 1, box_type, payload_size + 16).bytes
+        return bitstring.pack("uint:32, bytes:4", payload_size + 8, box_type).bytes
+
+    def box(self, box_type, payload, long_size=False):
+        return self.box_header(box_type, len(payload), long_size) + payload
+
+    def afra(self, time_scale, global_entries=None, local_entries=(), long_ids=None, long_offsets=None):
+        """ Returns an afra box. Field widths are picked from the entries unless
+        given """
+
+        global_entries = global_entries or []
+
+        if long_ids is None:
+            long_ids = any(max(e.segment_number, e.fragment_number) > MAX_UINT16 for e in global_entries)
+
+        if long_offsets is None:
+            long_offsets = any(e.offset > MAX_UINT32 for e in local_entries) or \
+                any(max(e.afra_offset, e.sample_offset) > MAX_UINT32 for e in global_entries)
+
+        id_bs_type = "uint:32" if long_ids else "uint:16"
+        offset_bs_type = "uint:64" if long_offsets else "uint:32"
+
+        afra_bs = bitstring.BitStream()
+        afra_bs.append(bitstring.pack("uint:8, uint:24, bool, bool, bool, uint:5, uint:32, uint:32",
+                                      0, 0, long_ids, long_offsets, bool(global_entries), 0,
+                                      time_scale, len(local_entries)))
+
+        for entry in local_entries:
+            afra_bs.append(bitstring.pack("uint:64", to_timescale(entry.time, time_scale)))
+            afra_bs.append(bitstring.pack(offset_bs_type, entry.offset))
+
+        if global_entries:
+            afra_bs.append(bitstring.pack("uint:32", len(global_entries)))
+
+            for entry in global_entries:
+                afra_bs.append(bitstring.pack("uint:64", to_timescale(entry.time, time_scale)))
+                afra_bs.append(bitstring.pack(id_bs_type, entry.segment_number))
+                afra_bs.append(bitstring.pack(id_bs_type, entry.fragment_number))
+                afra_bs.append(bitstring.pack(offset_bs_type, entry.afra_offset))
+                afra_bs.append(bitstring.pack(offset_bs_type, entry.sample_offset))
+
+        return self.box("afra", afra_bs.bytes)
+
+    def abst(self, abst):
+        """ Returns an abst box from a BootStrapInfoBox """
+
+        abst_bs = bitstring.BitStream()
+        abst_bs.append(bitstring.pack("uint:8, uint:24, uint:32, uint:2, bool, bool, uint:4, uint:32, uint:64, uint:64",
+                                      0, 0, abst.version, abst.profile_raw, abst.live, abst.update, 0,
+                                      abst.time_scale, to_timescale(abst.current_media_time, abst.time_scale),
+                                      abst.smpte_timecode_offset))
+        abst_bs.append(self._string(abst.movie_identifier))
+        abst_bs.append(self._count_and_string_table(abst.server_entry_table))
+        abst_bs.append(self._count_and_string_table(abst.quality_entry_table))
+        abst_bs.append(self._string(abst.drm_data))
+        abst_bs.append(self._string(abst.meta_data))
+
+        abst_bs.append(bitstring.pack("uint:8", len(abst.segment_run_tables)))
+        for asrt in abst.segment_run_tables:
+            abst_bs.append(bitstring.Bits(bytes=self.asrt(asrt)))
+
+        abst_bs.append(bitstring.pack("uint:8", len(abst.fragment_tables)))
+        for afrt in abst.fragment_tables:
+            abst_bs.append(bitstring.Bits(bytes=self.afrt(afrt)))
+
+        return self.box("abst", abst_bs.bytes)
+
+    def asrt(self, asrt):
+        """ Returns an asrt / Segment Run Table Box from a SegmentRunTable """
+
+        asrt_bs = bitstring.BitStream()
+        asrt_bs.append(bitstring.pack("uint:8, uint:24", 0, 1 if asrt.update else 0))
+        asrt_bs.append(self._count_and_string_table(asrt.quality_segment_url_modifiers))
+        asrt_bs.append(bitstring.pack("uint:32", len(asrt.segment_run_table_entries)))
+
+        for entry in asrt.segment_run_table_entries:
+            asrt_bs.append(bitstring.pack("uint:32, uint:32", entry.first_segment, entry.fragments_per_segment))
+
+        return self.box("asrt", asrt_bs.bytes)
+
+    def afrt(self, afrt):
+        """ Returns an afrt / Fragment Run Table Box from a FragmentRunTable """
+
+        afrt_bs = bitstring.BitStream()
+        afrt_bs.append(bitstring.pack("uint:8, uint:24, uint:32", 0, 1 if afrt.update else 0, afrt.time_scale))
+        afrt_bs.append(self._count_and_string_table(afrt.quality_fragment_url_modifiers))
+        afrt_bs.append(bitstring.pack("uint:32", len(afrt.fragments)))
+
+        for entry in afrt.fragments:
+            afrt_bs.append(bitstring.pack("uint:32, uint:64, uint:32", entry.first_fragment,
+                                          to_timescale(entry.first_fragment_timestamp, afrt.time_scale),
+                                          entry.fragment_duration))
+            if entry.fragment_duration == 0:
+                afrt_bs.append(bitstring.pack("uint:8", entry.discontinuity_indicator or 0))
+
+        return self.box("afrt", afrt_bs.bytes)
+
+    def _string(self, value):
+        """ UTF8 null terminated string. None is written as an empty string """
+        return bitstring.Bits(bytes=(value or u"").encode("utf-8") + "\x00")
+
+    def _count_and_string_table(self, values):
+        table_bs = bitstring.BitStream(bitstring.pack("uint:8", len(values)))
+        for value in values:
+            table_bs.append(self._string(value))
+        return table_bs
+
+
+class SyntheticSegmentWriter(object):
+    """ Writes an .f4f and .f4x pair made of fake afra, abst, moof, mdat
+    fragment groups. Used for benchmarks and load tests. Fragments can be
+    appended one at a time to imitate a live packager.
+
+    long_size writes every mdat with a 64-bit size. long_ids and long_offsets
+    force the field widths of the .f4x afra, which are otherwise picked from
+    the entries """
+
+    def __init__(self, f4x_filename, f4f_filename, segment_number=1, first_fragment_number=1,
+                 fragment_duration=4000, time_scale=1000, mdat_size=500 * 1024,
+                 long_size=False, long_ids=None, long_offsets=None):
+        self.f4x_filename = f4x_filename
+        self.f4f_filename = f4f_filename
+        self.segment_number = segment_number
+        self.next_fragment_number = first_fragment_number
+        self.fragment_duration = fragment_duration
+        self.time_scale = time_scale
+        self.mdat_size = mdat_size
+        self.long_size = long_size
+        self.long_ids = long_ids
+        self.long_offsets = long_offsets
+
+        self.writer = F4VWriter()
+        self.global_entries = []
+        self.f4f_size = 0
+
+        open(self.f4f_filename, "wb").close()
+
+    def append_fragment(self, mdat_payload=None, sparse=False):
+        """ Appends one fragment group to the .f4f. When sparse is True the
+        mdat payload is left as a hole, which keeps very large files cheap """
+
+        fragment_number = self.next_fragment_number
+        fragment_time = from_timescale((fragment_number - 1) * self.fragment_duration, self.time_scale)
+        afra_offset = self.f4f_size
+
+        afra_entry = FragmentRandomAccessBox.FragmentRandomAccessBoxGlobalEntry(
+                                            time=fragment_time,
+                                            segment_number=self.segment_number,
+                                            fragment_number=fragment_number,
+                                            afra_offset=afra_offset,
+                                            sample_offset=0)
+
+        moof = self.writer.box("moof", self.writer.box("mfhd", bitstring.pack("uint:32, uint:32", 0, fragment_number).bytes))
+
+        if mdat_payload is None and not sparse:
+            mdat_payload = chr(fragment_number % 256) * self.mdat_size
+        mdat_size = self.mdat_size if mdat_payload is None else len(mdat_payload)
+
+        fragment_header = self.writer.afra(self.time_scale, local_entries=[]) + \
+                            self._fragment_abst(fragment_number, fragment_time) + \
+                            moof + \
+                            self.writer.box_header("mdat", mdat_size, self.long_size)
+
+        with open(self.f4f_filename, "r+b") as f4f:
+            f4f.seek(afra_offset)
+            f4f.write(fragment_header)
+
+            if mdat_payload is None:
+                f4f.truncate(afra_offset + len(fragment_header) + mdat_size)
+            else:
+                f4f.write(mdat_payload)
+
+        self.f4f_size = afra_offset + len(fragment_header) + mdat_size
+        self.global_entries.append(afra_entry)
+        self.next_fragment_number += 1
+
+        return afra_entry
+
+    def append_recorded_fragment(self, fragment_data):
+        """ Appends a complete afra, abst, moof, mdat group, e.g. one split
+        from a real segment, in place of a synthetic one """
+
+        fragment_number = self.next_fragment_number
+        afra_offset = self.f4f_size
+
+        afra_entry = FragmentRandomAccessBox.FragmentRandomAccessBoxGlobalEntry(
+                                            time=from_timescale((fragment_number - 1) * self.fragment_duration,
+                                                                self.time_scale),
+                                            segment_number=self.segment_number,
+                                            fragment_number=fragment_number,
+                                            afra_offset=afra_offset,
+                                            sample_offset=0)
+
+        with open(self.f4f_filename, "r+b") as f4f:
+            f4f.seek(afra_offset)
+            f4f.write(fragment_data)
+
+        self.f4f_size = afra_offset + len(fragment_data)
+        self.global_entries.append(afra_entry)
+        self.next_fragment_number += 1
+
+        return afra_entry
+
+    def write_index(self):
+        """ (Re)writes the .f4x. The file is replaced atomically, as packagers do """
+
+        temp_filename = self.f4x_filename + ".tmp"
+        with open(temp_filename, "wb") as f4x:
+            f4x.write(self.writer.afra(self.time_scale, global_entries=self.global_entries,
+                                       long_ids=self.long_ids, long_offsets=self.long_offsets))
+        os.rename(temp_filename, self.f4x_filename)
+
+    def _fragment_abst(self, fragment_number, fragment_time):
+        asrt = SegmentRunTable()
+        asrt.update = False
+        asrt.quality_segment_url_modifiers = []
+        asrt.segment_run_table_entries = [SegmentRunTable.SegmentRunTableEntry(first_segment=self.segment_number,
+                                                                               fragments_per_segment=fragment_number)]
+
+        afrt = FragmentRunTable()
+        afrt.update = False
+        afrt.time_scale = self.time_scale
+        afrt.quality_fragment_url_modifiers = []
+        afrt.fragments = [FragmentRunTable.FragmentRunTableEntry(first_fragment=fragment_number,
+                                                                 first_fragment_timestamp=fragment_time,
+                                                                 fragment_duration=self.fragment_duration,
+                                                                 discontinuity_indicator=None)]
+
+        abst = BootStrapInfoBox()
+        abst.version = fragment_number
+        abst.profile_raw = 0
+        abst.live = True
+        abst.update = False
+        abst.time_scale = self.time_scale
+        abst.current_media_time = fragment_number * self.fragment_duration
+        abst.smpte_timecode_offset = 0
+        abst.movie_identifier = None
+        abst.server_entry_table = []
+        abst.quality_entry_table = []
+        abst.drm_data = None
+        abst.meta_data = None
+        abst.segment_run_tables = [asrt]
+        abst.fragment_tables = [afrt]
+
+        return self.writer.abst(abst)
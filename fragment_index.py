@@ -0,0 +1,147 @@
+""" Content hashes of fragments and a local index of them.
+
+The index records the digest of every fragment written or uploaded, so that
+re-runs can skip files whose content hasn't changed.
+
+@author: Alastair McCormack
+@license: MIT License
+
+"""
+
+import hashlib
+import json
+import logging
+import os.path
+import shutil
+import tempfile
+import zlib
+from collections import namedtuple, OrderedDict
+from threading import Lock
+
+class NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+log = logging.getLogger(__name__)
+log.addHandler(NullHandler())
+log.setLevel(logging.FATAL)
+
+FragmentDigest = namedtuple("FragmentDigest", ["md5", "fast_hash", "size"])
+
+# The journal is compacted once it has this many lines and is at least
+# twice as long as the index
+JOURNAL_COMPACT_MIN_LINES = 1000
+
+class FragmentHasher(object):
+    """ Streaming hasher. md5 matches the S3 ETag of a single part upload.
+    fast_hash is a CRC32, cheap enough to compare on every event """
+
+    def __init__(self):
+        self._md5 = hashlib.md5()
+        self._crc32 = 0
+        self.size = 0
+
+    def update(self, data):
+        self._md5.update(data)
+        self._crc32 = zlib.crc32(data, self._crc32)
+        self.size += len(data)
+
+    def digest(self):
+        return FragmentDigest(md5=self._md5.hexdigest(),
+                              fast_hash="%08x" % (self._crc32 & 0xFFFFFFFF),
+                              size=self.size)
+
+def digest_of(data):
+    """ Returns the FragmentDigest of a complete payload """
+    hasher = FragmentHasher()
+    hasher.update(data)
+    return hasher.digest()
+
+
+class FragmentIndex(object):
+    """ Maps fragment names to FragmentDigests.
+
+    Kept on disk as a journal of JSON lines, so recording an entry is a cheap
+    append. The journal is compacted when it is loaded and whenever it grows
+    to twice the size of the index. Without a filename the index only lives
+    in memory. With maxlen, only the most recently recorded names are kept """
+
+    def __init__(self, filename=None, maxlen=None):
+        self.filename = filename
+        self.maxlen = maxlen
+        self._digests = OrderedDict()
+        self._journal_lines = 0
+        self._lock = Lock()
+
+        if filename and os.path.exists(filename):
+            self._load()
+
+    def get(self, name):
+        with self._lock:
+            return self._digests.get(name)
+
+    def is_unchanged(self, name, digest):
+        """ True if name was last recorded with the same content """
+        recorded_digest = self.get(name)
+        return recorded_digest is not None and digest is not None and \
+            recorded_digest.fast_hash == digest.fast_hash and recorded_digest == digest
+
+    def record(self, name, digest):
+        with self._lock:
+            self._add(name, digest)
+
+            if self.filename:
+                with open(self.filename, "a") as journal:
+                    journal.write(self._journal_line(name, digest))
+                self._journal_lines += 1
+
+                if self._journal_lines >= max(JOURNAL_COMPACT_MIN_LINES, 2 * len(self._digests)):
+                    self._compact()
+
+    def __len__(self):
+        return len(self._digests)
+
+    def _add(self, name, digest):
+        # re-inserted so that the oldest entries are dropped first
+        self._digests.pop(name, None)
+        self._digests[name] = digest
+
+        if self.maxlen is not None:
+            while len(self._digests) > self.maxlen:
+                self._digests.popitem(last=False)
+
+    def _journal_line(self, name, digest):
+        entry = digest._asdict()
+        entry["name"] = name
+        return json.dumps(entry, sort_keys=True) + "\n"
+
+    def _load(self):
+        line_count = 0
+
+        with open(self.filename) as journal:
+            for line in journal:
+                line_count += 1
+                try:
+                    entry = json.loads(line)
+                    name = entry.pop("name")
+                    self._add(name, FragmentDigest(**entry))
+                except (ValueError, KeyError, TypeError):
+                    # most likely a line cut short by a crash
+                    log.warn("Ignoring bad line %d in %s", line_count, self.filename)
+
+        log.info("Loaded %d fragment digests from %s", len(self._digests), self.filename)
+
+        self._journal_lines = line_count
+        if line_count > len(self._digests):
+            self._compact()
+
+    def _compact(self):
+        temp_journal = tempfile.NamedTemporaryFile(dir=os.path.dirname(self.filename) or ".", delete=False)
+        # oldest first, so that maxlen drops the same entries after a reload
+        for name, digest in self._digests.items():
+            temp_journal.write(self._journal_line(name, digest))
+        temp_journal.close()
+
+        log.info("Compacting %s", self.filename)
+        shutil.move(temp_journal.name, self.filename)
+        self._journal_lines = len(self._digests)
@@ -0,0 +1,477 @@
+""" Load generator for S3Inotifier.
+
+Imitates live packagers writing N streams x M bitrates into a watched
+directory in real time, runs S3HDSAutoUploader against an in-process fake S3
+and reports how long manifests, fragments and bootstraps took to be
+published, how many bootstraps were published before the fragment they
+advertise, the throughput and the memory used. Options after -- are passed to S3Inotifier,
+so thread counts, queue policies and split strategies can be compared:
+
+    python hds_load_generator.py -n 4 -b 500 1500 3000 -t 120 -- -e --upload-workers 10
+
+@author: Alastair McCormack
+@license: MIT License
+
+"""
+
+import logging
+import math
+import os.path
+import resource
+import shutil
+import signal
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from threading import Thread, Lock
+from xml.etree import ElementTree
+from bootstrap_diff import parse_bootstrap, live_edge, BootstrapDiffException
+from f4v import BootStrapInfoBox, SegmentRunTable, FragmentRunTable
+from f4v_writer import F4VWriter, SyntheticSegmentWriter, from_timescale
+from fragment_index import digest_of
+from hds_packager import write_atomically, F4M_1_NAMESPACE
+from hds_seg_fragmenter import HDSSegSplitter
+from S3Inotifier import S3HDSAutoUploader, fragment_name
+
+class NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+log = logging.getLogger(__name__)
+log.addHandler(NullHandler())
+log.setLevel(logging.FATAL)
+
+TIME_SCALE = 1000
+POLL_SECONDS = 0.2
+
+# live_edge_fragment is the newest fragment a published .bootstrap advertises.
+# Bootstraps are matched by it, not by content, as S3Inotifier may trim them
+PublishedObject = namedtuple("PublishedObject", ["name", "md5", "size", "publish_time", "live_edge_fragment"])
+WrittenFragment = namedtuple("WrittenFragment", ["name", "size", "index_time", "bootstrap_name", "fragment_number",
+                                                 "bootstrap_time"])
+WrittenManifest = namedtuple("WrittenManifest", ["name", "write_time"])
+LatencySummary = namedtuple("LatencySummary", ["written", "published", "p50", "p90", "p99", "max"])
+
+def percentile(sorted_values, fraction):
+    """ Nearest rank percentile of an already sorted list """
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, int(math.ceil(fraction * len(sorted_values))) - 1)]
+
+def summarise_latencies(written_count, latencies):
+    latencies = sorted(latencies)
+    return LatencySummary(written=written_count, published=len(latencies),
+                          p50=percentile(latencies, 0.5), p90=percentile(latencies, 0.9),
+                          p99=percentile(latencies, 0.99), max=latencies[-1] if latencies else None)
+
+
+class FakeS3Adapter(object):
+    """ In-process stand-in for S3UploadAdapter. Records when each object was
+    published, and the live edge of each bootstrap, rather than keeping it.
+    One instance is shared by every uploader. put_latency imitates the round
+    trip of a real PUT """
+
+    def __init__(self, put_latency=0):
+        self.put_latency = put_latency
+        self.published = []
+        self._lock = Lock()
+
+    def upload(self, filename, contents_bytes, content_type=None, md5=None):
+        if self.put_latency:
+            time.sleep(self.put_latency)
+
+        name = os.path.basename(filename)
+        live_edge_fragment = self._live_edge_fragment(contents_bytes) if name.endswith(".bootstrap") else None
+
+        published_object = PublishedObject(name=name, md5=md5 or digest_of(contents_bytes).md5,
+                                           size=len(contents_bytes), publish_time=time.time(),
+                                           live_edge_fragment=live_edge_fragment)
+        with self._lock:
+            self.published.append(published_object)
+        return True
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.published)
+
+    def _live_edge_fragment(self, contents_bytes):
+        try:
+            edge = live_edge(parse_bootstrap(contents_bytes))
+        except BootstrapDiffException as e:
+            log.warn("Published an unreadable bootstrap: %s", e)
+            return None
+
+        return edge.fragment_number if edge else None
+
+
+class LiveRendition(object):
+    """ One bitrate of one stream, written as a live packager does: each
+    fragment is appended to the .f4f, then the .f4x is replaced and the
+    .bootstrap rewritten. A new segment is started every
+    fragments_per_segment fragments. recorded_fragments, if given, are
+    replayed in a loop instead of writing synthetic fragments. Nothing is
+    written until write_manifest() is called """
+
+    def __init__(self, watch_dir, stream_name, bitrate, fragment_duration, fragments_per_segment,
+                 recorded_fragments=None):
+        self.watch_dir = watch_dir
+        self.stream_name = stream_name
+        self.bitrate = bitrate
+        self.fragment_duration = int(fragment_duration * TIME_SCALE)
+        self.fragments_per_segment = fragments_per_segment
+        self.recorded_fragments = recorded_fragments
+
+        self.mdat_size = int(bitrate * 1000 / 8 * fragment_duration)
+        self.fragment_count = 0
+        self.segment_writer = None
+        self.writer = F4VWriter()
+
+        self.bootstrap_filename = os.path.join(watch_dir, stream_name + ".bootstrap")
+        self.manifest_filename = os.path.join(watch_dir, stream_name + ".f4m")
+
+    def write_manifest(self):
+        """ Writes the .f4m and returns a WrittenManifest """
+
+        write_atomically(self.manifest_filename, self.build_manifest())
+        return WrittenManifest(name=os.path.basename(self.manifest_filename), write_time=time.time())
+
+    def write_fragment(self):
+        """ Writes the next fragment and bootstrap and returns a WrittenFragment """
+
+        if self.segment_writer is None or len(self.segment_writer.global_entries) >= self.fragments_per_segment:
+            self._start_segment()
+
+        if self.recorded_fragments:
+            fragment_data = self.recorded_fragments[self.fragment_count % len(self.recorded_fragments)]
+            afra_entry = self.segment_writer.append_recorded_fragment(fragment_data)
+            fragment_size = len(fragment_data)
+        else:
+            f4f_size = self.segment_writer.f4f_size
+            afra_entry = self.segment_writer.append_fragment()
+            fragment_size = self.segment_writer.f4f_size - f4f_size
+
+        self.segment_writer.write_index()
+        index_time = time.time()
+        self.fragment_count += 1
+
+        bootstrap = self.writer.abst(self.build_bootstrap())
+        write_atomically(self.bootstrap_filename, bootstrap)
+
+        return WrittenFragment(name=fragment_name(self.stream_name, afra_entry.segment_number, afra_entry.fragment_number),
+                               size=fragment_size, index_time=index_time,
+                               bootstrap_name=os.path.basename(self.bootstrap_filename),
+                               fragment_number=afra_entry.fragment_number, bootstrap_time=time.time())
+
+    def build_bootstrap(self):
+        """ Returns a live BootStrapInfoBox ending at the newest fragment """
+
+        asrt = SegmentRunTable()
+        asrt.update = False
+        asrt.quality_segment_url_modifiers = []
+        asrt.segment_run_table_entries = [SegmentRunTable.SegmentRunTableEntry(
+                                            first_segment=1, fragments_per_segment=self.fragments_per_segment)]
+
+        afrt = FragmentRunTable()
+        afrt.update = False
+        afrt.time_scale = TIME_SCALE
+        afrt.quality_fragment_url_modifiers = []
+        afrt.fragments = [FragmentRunTable.FragmentRunTableEntry(first_fragment=1,
+                                                                 first_fragment_timestamp=from_timescale(0, TIME_SCALE),
+                                                                 fragment_duration=self.fragment_duration,
+                                                                 discontinuity_indicator=None)]
+
+        abst = BootStrapInfoBox()
+        abst.version = self.fragment_count
+        abst.profile_raw = 0
+        abst.live = True
+        abst.update = False
+        abst.time_scale = TIME_SCALE
+        abst.current_media_time = self.fragment_count * self.fragment_duration
+        abst.smpte_timecode_offset = 0
+        abst.movie_identifier = None
+        abst.server_entry_table = []
+        abst.quality_entry_table = []
+        abst.drm_data = None
+        abst.meta_data = None
+        abst.segment_run_tables = [asrt]
+        abst.fragment_tables = [afrt]
+
+        return abst
+
+    def build_manifest(self):
+        """ Returns a live stream-level .f4m """
+
+        bootstrap_id = "bootstrap_" + self.stream_name
+
+        manifest = ElementTree.Element("manifest", xmlns=F4M_1_NAMESPACE)
+        ElementTree.SubElement(manifest, "id").text = self.stream_name
+        ElementTree.SubElement(manifest, "streamType").text = "live"
+        ElementTree.SubElement(manifest, "bootstrapInfo", profile="named", id=bootstrap_id,
+                               url=self.stream_name + ".bootstrap")
+        ElementTree.SubElement(manifest, "media", streamId=self.stream_name, url=self.stream_name,
+                               bitrate=str(self.bitrate), bootstrapInfoId=bootstrap_id)
+
+        return '<?xml version="1.0" encoding="utf-8"?>\n' + ElementTree.tostring(manifest)
+
+    def _start_segment(self):
+        segment_number = self.segment_writer.segment_number + 1 if self.segment_writer else 1
+        basename = os.path.join(self.watch_dir, "%sSeg%d" % (self.stream_name, segment_number))
+
+        self.segment_writer = SyntheticSegmentWriter(basename + ".f4x", basename + ".f4f",
+                                                     segment_number=segment_number,
+                                                     first_fragment_number=self.fragment_count + 1,
+                                                     fragment_duration=self.fragment_duration,
+                                                     time_scale=TIME_SCALE, mdat_size=self.mdat_size)
+
+
+class LoadGenerator(object):
+    """ Writes the manifest of every rendition, then a fragment to every
+    rendition each fragment_duration / speed seconds for duration seconds,
+    then waits up to drain_timeout seconds for the last of them to be
+    published. Run it once S3Inotifier is watching, so that the manifests
+    are seen """
+
+    def __init__(self, renditions, fragment_duration, duration, speed=1.0, drain_timeout=30):
+        self.renditions = renditions
+        self.interval = fragment_duration / float(speed)
+        self.duration = duration
+        self.drain_timeout = drain_timeout
+
+        self.written = []
+        self.manifests = []
+        self.late_ticks = 0
+        self.start_time = None
+        self.end_time = None
+        self._stopping = threading.Event()
+
+    def run(self, object_store):
+        self.start_time = time.time()
+        next_tick = self.start_time
+        end = self.start_time + self.duration
+
+        self.manifests = [rendition.write_manifest() for rendition in self.renditions]
+
+        while not self._stopping.is_set() and next_tick < end:
+            for rendition in self.renditions:
+                self.written.append(rendition.write_fragment())
+
+            next_tick += self.interval
+            delay = next_tick - time.time()
+
+            if delay > 0:
+                self._stopping.wait(delay)
+            else:
+                log.warn("Writing fragments took longer than %.2f seconds", self.interval)
+                self.late_ticks += 1
+
+        self.end_time = time.time()
+        self._drain(object_store)
+
+    def stop(self):
+        self._stopping.set()
+
+    def _drain(self, object_store):
+        # manifests, fragments and the final bootstraps must all be published
+        expected_names = set(written.name for written in self.written + self.manifests)
+        expected_bootstraps = set((written.bootstrap_name, written.fragment_number)
+                                  for written in self.written[-len(self.renditions):])
+        deadline = time.time() + self.drain_timeout
+
+        while not self._stopping.is_set() and time.time() < deadline:
+            published = object_store.snapshot()
+            if (expected_names.issubset(p.name for p in published) and
+                    expected_bootstraps.issubset((p.name, p.live_edge_fragment) for p in published)):
+                return
+            self._stopping.wait(POLL_SECONDS)
+
+        if not self._stopping.is_set():
+            log.warn("Stopped waiting for uploads after %d seconds", self.drain_timeout)
+
+
+def build_report(load_generator, object_store):
+    """ Returns the report lines for a finished load test """
+
+    published = object_store.snapshot()
+
+    first_publish_times = {}
+    bootstrap_publish_times = {}
+    for published_object in published:
+        first_publish_times.setdefault(published_object.name, published_object.publish_time)
+        if published_object.live_edge_fragment is not None:
+            bootstrap_publish_times.setdefault((published_object.name, published_object.live_edge_fragment),
+                                               published_object.publish_time)
+
+    fragment_latencies = [first_publish_times[w.name] - w.index_time for w in load_generator.written
+                          if w.name in first_publish_times]
+    # bootstraps superseded before upload are never published
+    bootstrap_latencies = [bootstrap_publish_times[(w.bootstrap_name, w.fragment_number)] - w.bootstrap_time
+                           for w in load_generator.written
+                           if (w.bootstrap_name, w.fragment_number) in bootstrap_publish_times]
+
+    # a player fetching the live edge of these bootstraps would have got a 404
+    advertised_fragments = dict(((w.bootstrap_name, w.fragment_number), w.name) for w in load_generator.written)
+    early_bootstraps = 0
+    for (bootstrap_name, fragment_number), publish_time in bootstrap_publish_times.items():
+        fragment_name = advertised_fragments.get((bootstrap_name, fragment_number))
+        if fragment_name and first_publish_times.get(fragment_name, float("inf")) > publish_time:
+            early_bootstraps += 1
+
+    written_bytes = sum(w.size for w in load_generator.written)
+    published_bytes = sum(p.size for p in published)
+    last_publish_time = max([p.publish_time for p in published] or [load_generator.end_time])
+    seconds = max(last_publish_time, load_generator.end_time) - load_generator.start_time
+
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    manifest_latencies = [first_publish_times[m.name] - m.write_time for m in load_generator.manifests
+                          if m.name in first_publish_times]
+
+    lines = []
+    for label, summary in (("Manifests", summarise_latencies(len(load_generator.manifests), manifest_latencies)),
+                           ("Fragments", summarise_latencies(len(load_generator.written), fragment_latencies)),
+                           ("Bootstraps", summarise_latencies(len(load_generator.written), bootstrap_latencies))):
+        lines.append("{label:>11}: {written:6d} written {published:6d} published".format(label=label, **summary._asdict()))
+        if summary.published:
+            lines.append("{0:>11}  p50 {p50:7.3f}s  p90 {p90:7.3f}s  p99 {p99:7.3f}s  max {max:7.3f}s".format(
+                            "latency", **summary._asdict()))
+    lines.append("{0:>11}  {1} of {2} published before the fragment they advertise".format(
+                    "", early_bootstraps, len(bootstrap_publish_times)))
+
+    lines.append("{0:>11}: {1:.1f} MB written, {2:.1f} MB published in {3:.1f}s ({4:.2f} MB/s, {5:.1f} objects/s)".format(
+                    "Throughput", written_bytes / 1048576.0, published_bytes / 1048576.0, seconds,
+                    published_bytes / 1048576.0 / max(seconds, 1e-9), len(published) / max(seconds, 1e-9)))
+    lines.append("{0:>11}: {1} of {2} ticks late".format("Generator", load_generator.late_ticks,
+                                                         len(load_generator.written) // max(len(load_generator.renditions), 1)))
+    # ru_maxrss is in KB on Linux
+    lines.append("{0:>11}: peak RSS {1:.1f} MB (daemon and generator), {2:.1f} MB (largest child process)".format(
+                    "Memory", self_usage.ru_maxrss / 1024.0, children_usage.ru_maxrss / 1024.0))
+    lines.append("{0:>11}: {1:.1f}s user {2:.1f}s system, {3:.1f}s in child processes".format(
+                    "CPU", self_usage.ru_utime, self_usage.ru_stime, children_usage.ru_utime + children_usage.ru_stime))
+
+    return lines
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Measure S3Inotifier against imitation live packagers and an in-process fake S3')
+
+    parser.add_argument("-n", '--streams', dest="stream_count", type=int,
+                        default=2,
+                        help="Live streams (default: %(default)s)")
+
+    parser.add_argument("-b", '--bitrates', dest="bitrates", type=int, nargs="+",
+                        default=[500, 1500],
+                        help="Bitrates of each stream in kbps. They set the synthetic fragment sizes (default: %(default)s)")
+
+    parser.add_argument("-t", '--duration', dest="duration", type=float,
+                        default=60,
+                        help="Seconds to write fragments for (default: %(default)s)")
+
+    parser.add_argument("-f", '--fragment-duration', dest="fragment_duration", type=float,
+                        default=4,
+                        help="Fragment duration in seconds (default: %(default)s)")
+
+    parser.add_argument("-g", '--fragments-per-segment', dest="fragments_per_segment", type=int,
+                        default=15,
+                        help="Fragments per segment before a new one is started (default: %(default)s)")
+
+    parser.add_argument("-x", '--speed', dest="speed", type=float,
+                        default=1.0,
+                        help="Multiple of real time to write fragments at (default: %(default)s)")
+
+    parser.add_argument("-r", '--replay', dest="replay_f4x", metavar="SEGMENT_FILE",
+                        default=None,
+                        help="Replay the fragments of a recorded segment (.f4x) instead of synthetic ones")
+
+    parser.add_argument("-p", '--put-latency', dest="put_latency", type=float,
+                        default=0.05,
+                        help="Seconds each fake S3 PUT takes (default: %(default)s)")
+
+    parser.add_argument("-w", '--watch-dir', dest="watch_dir",
+                        default=None,
+                        help="Directory to write to. It must be empty and is kept afterwards (default: a temporary "
+                             "directory, removed afterwards)")
+
+    parser.add_argument('--drain-timeout', dest="drain_timeout", type=float,
+                        default=30,
+                        help="Seconds to wait for uploads once writing stops (default: %(default)s)")
+
+    parser.add_argument('-D', "--debug", dest="debug", action="store_true",
+                        default=False,
+                        help="Enable debug")
+
+    parser.add_argument('daemon_args', nargs=argparse.REMAINDER,
+                        help="S3Inotifier options, after --")
+
+    args = parser.parse_args()
+
+    if args.watch_dir and os.path.isdir(args.watch_dir) and os.listdir(args.watch_dir):
+        parser.error("Watch directory %s is not empty" % args.watch_dir)
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    log.setLevel(logging.DEBUG if args.debug else logging.INFO)
+
+    daemon_args = args.daemon_args[1:] if args.daemon_args[:1] == ["--"] else args.daemon_args
+
+    watch_dir = args.watch_dir or tempfile.mkdtemp()
+    if not os.path.isdir(watch_dir):
+        os.makedirs(watch_dir)
+
+    recorded_fragments = None
+    if args.replay_f4x:
+        recorded_fragments = [fragment.data for fragment in HDSSegSplitter(args.replay_f4x).split()]
+        logging.info("Replaying %d fragments from %s", len(recorded_fragments), args.replay_f4x)
+
+    object_store = FakeS3Adapter(put_latency=args.put_latency)
+    uploader = S3HDSAutoUploader(file_adapter_factory=lambda: object_store)
+    uploader.configure(["-s", watch_dir] + daemon_args)
+
+    if not args.debug:
+        # the daemon logs every upload at INFO
+        logging.getLogger("S3Inotifer").setLevel(logging.WARNING)
+
+    renditions = [LiveRendition(watch_dir, "stream%d_%d" % (stream_number, bitrate), bitrate,
+                                args.fragment_duration, args.fragments_per_segment, recorded_fragments)
+                  for stream_number in xrange(1, args.stream_count + 1) for bitrate in args.bitrates]
+
+    load_generator = LoadGenerator(renditions, args.fragment_duration, args.duration, speed=args.speed,
+                                   drain_timeout=args.drain_timeout)
+
+    def generate_load():
+        try:
+            # events before the watch is added would be missed
+            uploader.started.wait()
+            load_generator.run(object_store)
+        finally:
+            uploader.stop()
+
+    def stop(signum, frame):
+        load_generator.stop()
+        uploader.stop()
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, stop)
+
+    logging.info("Writing %d renditions to %s. S3Inotifier options: %s", len(renditions), watch_dir,
+                 " ".join(daemon_args) or "(defaults)")
+
+    generator_thread = Thread(target=generate_load, name="LoadGenerator")
+    generator_thread.daemon = True
+    generator_thread.start()
+
+    try:
+        uploader.run()
+        # the generator may still be draining if the daemon was stopped first
+        load_generator.stop()
+        generator_thread.join()
+
+        if load_generator.end_time:
+            for line in build_report(load_generator, object_store):
+                print line
+    finally:
+        if not args.watch_dir:
+            shutil.rmtree(watch_dir)
@@ -0,0 +1,327 @@
+""" Packages HDS VOD assets. Every bitrate rendition of an asset is split into
+fragments and given a bootstrap and a stream-level .f4m, then a set-level
+.f4m is written for the whole ABR ladder.
+
+@author: Alastair McCormack
+@license: MIT License
+
+"""
+
+import logging
+import multiprocessing
+import os.path
+import shutil
+import tempfile
+from collections import namedtuple, OrderedDict
+from xml.etree import ElementTree
+from f4v import F4VParser, BootStrapInfoBox, SegmentRunTable, FragmentRunTable
+from f4v_writer import F4VWriter, to_timescale, from_timescale
+from hds_seg_fragmenter import HDSSegSplitter
+
+class NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+log = logging.getLogger(__name__)
+log.addHandler(NullHandler())
+log.setLevel(logging.FATAL)
+
+F4M_1_NAMESPACE = "http://ns.adobe.com/f4m/1.0"
+F4M_2_NAMESPACE = "http://ns.adobe.com/f4m/2.0"
+
+Rendition = namedtuple("Rendition", ["stream_name", "f4x_filenames", "bitrate"])
+PackagedRendition = namedtuple("PackagedRendition", ["stream_name", "bitrate", "duration",
+                                                     "bootstrap_filename", "manifest_filename"])
+
+class HDSPackagerException(Exception):
+    pass
+
+def group_renditions(f4x_filenames, bitrates=None):
+    """ Groups .f4x files into Renditions by stream name. bitrates is an
+    optional dict of stream name to kbps """
+
+    bitrates = bitrates or {}
+    grouped = OrderedDict()
+
+    for f4x_filename in f4x_filenames:
+        basename = os.path.splitext(os.path.basename(f4x_filename))[0]
+        stream_name = basename.split("Seg", 1)[0]
+        grouped.setdefault(stream_name, []).append(f4x_filename)
+
+    return [Rendition(stream_name=stream_name, f4x_filenames=filenames, bitrate=bitrates.get(stream_name))
+            for stream_name, filenames in grouped.items()]
+
+def write_atomically(filename, data):
+    """ Writes to a temp file in the same directory then moves it into place """
+
+    temp_file = tempfile.NamedTemporaryFile(dir=os.path.dirname(filename) or ".", delete=False)
+    log.debug("Created tempfile for writing: %s", temp_file.name)
+    temp_file.write(data)
+    temp_file.close()
+
+    log.info("Moving temp file (%s) to: %s", temp_file.name, filename)
+    shutil.move(temp_file.name, filename)
+
+def package_rendition(job):
+    """ Packages one rendition. Module level so it can run in a worker process """
+
+    rendition, destination_dir, force_overwrite, linear = job
+    return RenditionPackager(rendition, destination_dir).package(force_overwrite=force_overwrite,
+                                                                  linear=linear)
+
+
+class RenditionPackager(object):
+    """ Writes the fragments, bootstrap and stream-level .f4m of one rendition.
+    Each .f4x index is parsed once and shared by all three stages """
+
+    def __init__(self, rendition, destination_dir):
+        self.rendition = rendition
+        self.destination_dir = destination_dir
+
+        self.splitters = [HDSSegSplitter(f4x_filename) for f4x_filename in rendition.f4x_filenames]
+
+    def package(self, force_overwrite=False, linear=False):
+        for splitter in self.splitters:
+            log.info("Splitting %s", splitter.f4x_filename)
+            splitter.create_file_fragments(destination_dir=self.destination_dir,
+                                           force_overwrite=force_overwrite, linear=linear)
+
+        abst = self.build_bootstrap()
+        duration = (to_timescale(abst.current_media_time, abst.time_scale) -
+                    to_timescale(abst.fragment_tables[0].fragments[0].first_fragment_timestamp, abst.time_scale)) \
+                    / float(abst.time_scale)
+
+        bitrate = self.rendition.bitrate
+        if not bitrate:
+            media_bytes = sum(os.path.getsize(splitter.f4f_filename) for splitter in self.splitters)
+            bitrate = int(round(media_bytes * 8 / duration / 1000)) if duration else 0
+            log.info("Estimated bitrate of %s as %dkbps", self.rendition.stream_name, bitrate)
+
+        bootstrap_filename = os.path.join(self.destination_dir, self.rendition.stream_name + ".bootstrap")
+        write_atomically(bootstrap_filename, F4VWriter().abst(abst))
+
+        manifest_filename = os.path.join(self.destination_dir, self.rendition.stream_name + ".f4m")
+        write_atomically(manifest_filename, self.build_manifest(bitrate, duration))
+
+        return PackagedRendition(stream_name=self.rendition.stream_name, bitrate=bitrate, duration=duration,
+                                 bootstrap_filename=bootstrap_filename, manifest_filename=manifest_filename)
+
+    def build_bootstrap(self):
+        """ Returns a VOD BootStrapInfoBox built from the f4x indexes """
+
+        entries = []
+        time_scale = None
+
+        for splitter in self.splitters:
+            entries.extend(splitter.global_access_entries())
+            time_scale = time_scale or splitter.time_scale
+
+        if not entries:
+            raise HDSPackagerException("No fragments found for %s" % self.rendition.stream_name)
+
+        entries.sort(key=lambda fe: (fe.segment_number, fe.fragment_number))
+
+        fragment_times = [to_timescale(fe.time, time_scale) for fe in entries]
+        durations = [end - start for start, end in zip(fragment_times, fragment_times[1:])]
+        durations.append(self._last_fragment_duration(entries[-1], time_scale, durations))
+
+        abst = BootStrapInfoBox()
+        abst.version = 1
+        abst.profile_raw = 0
+        abst.live = False
+        abst.update = False
+        abst.time_scale = time_scale
+        abst.current_media_time = fragment_times[-1] + durations[-1]
+        abst.smpte_timecode_offset = 0
+        abst.movie_identifier = None
+        abst.server_entry_table = []
+        abst.quality_entry_table = []
+        abst.drm_data = None
+        abst.meta_data = None
+        abst.segment_run_tables = [self._build_asrt(entries)]
+        abst.fragment_tables = [self._build_afrt(entries, fragment_times, durations, time_scale)]
+
+        return abst
+
+    def build_manifest(self, bitrate, duration):
+        """ Returns a stream-level .f4m """
+
+        stream_name = self.rendition.stream_name
+        bootstrap_id = "bootstrap_" + stream_name
+
+        manifest = ElementTree.Element("manifest", xmlns=F4M_1_NAMESPACE)
+        ElementTree.SubElement(manifest, "id").text = stream_name
+        ElementTree.SubElement(manifest, "streamType").text = "recorded"
+        ElementTree.SubElement(manifest, "duration").text = "%.3f" % duration
+        ElementTree.SubElement(manifest, "bootstrapInfo", profile="named", id=bootstrap_id,
+                               url=stream_name + ".bootstrap")
+        ElementTree.SubElement(manifest, "media", streamId=stream_name, url=stream_name,
+                               bitrate=str(bitrate), bootstrapInfoId=bootstrap_id)
+
+        return _to_xml(manifest)
+
+    def _last_fragment_duration(self, fe, time_scale, durations):
+        """ The f4x only gives fragment start times. The last fragment's length
+        comes from the abst embedded in it, else from its predecessor """
+
+        fragment_boxes = F4VParser().parse(filename=self._splitter_for(fe).f4f_filename, offset_bytes=fe.afra_offset)
+
+        for box in fragment_boxes:
+            if isinstance(box, BootStrapInfoBox):
+                for afrt in box.fragment_tables:
+                    # the last run starting at or before the fragment covers it
+                    covering_runs = [frte for frte in afrt.fragments if frte.first_fragment <= fe.fragment_number]
+                    if covering_runs and covering_runs[-1].fragment_duration:
+                        return covering_runs[-1].fragment_duration * time_scale / afrt.time_scale
+                break
+
+        return durations[-1] if durations else 0
+
+    def _splitter_for(self, fe):
+        for splitter in self.splitters:
+            if fe in splitter.global_access_entries():
+                return splitter
+
+    def _build_asrt(self, entries):
+        fragments_per_segment = OrderedDict()
+        for fe in entries:
+            fragments_per_segment[fe.segment_number] = fragments_per_segment.get(fe.segment_number, 0) + 1
+
+        asrt = SegmentRunTable()
+        asrt.update = False
+        asrt.quality_segment_url_modifiers = []
+        asrt.segment_run_table_entries = []
+
+        for segment_number, fragment_count in fragments_per_segment.items():
+            # a run continues while consecutive segments hold the same number of fragments
+            if asrt.segment_run_table_entries:
+                last_run = asrt.segment_run_table_entries[-1]
+                if last_run.fragments_per_segment == fragment_count and \
+                        segment_number == previous_segment_number + 1:
+                    previous_segment_number = segment_number
+                    continue
+
+            asrt.segment_run_table_entries.append(
+                SegmentRunTable.SegmentRunTableEntry(first_segment=segment_number,
+                                                     fragments_per_segment=fragment_count))
+            previous_segment_number = segment_number
+
+        return asrt
+
+    def _build_afrt(self, entries, fragment_times, durations, time_scale):
+        afrt = FragmentRunTable()
+        afrt.update = False
+        afrt.time_scale = time_scale
+        afrt.quality_fragment_url_modifiers = []
+        afrt.fragments = []
+
+        previous = None
+        for fe, fragment_time, duration in zip(entries, fragment_times, durations):
+            # a run continues while fragments are numbered consecutively with the same duration
+            if previous is None or duration != previous[1] or fe.fragment_number != previous[0] + 1:
+                afrt.fragments.append(FragmentRunTable.FragmentRunTableEntry(
+                                            first_fragment=fe.fragment_number,
+                                            first_fragment_timestamp=from_timescale(fragment_time, time_scale),
+                                            fragment_duration=duration,
+                                            discontinuity_indicator=None))
+            previous = (fe.fragment_number, duration)
+
+        return afrt
+
+
+class HDSPackager(object):
+    """ Packages all renditions of an asset concurrently, one worker process
+    per rendition, then writes the set-level .f4m """
+
+    def __init__(self, asset_name, destination_dir, processes=None):
+        self.asset_name = asset_name
+        self.destination_dir = destination_dir
+        self.processes = processes
+
+    def package(self, renditions, force_overwrite=False, linear=False):
+        if self.asset_name in [rendition.stream_name for rendition in renditions]:
+            raise HDSPackagerException("Asset name (%s) clashes with a stream name" % self.asset_name)
+
+        if not os.path.exists(self.destination_dir):
+            log.info("Creating destination directory: %s", self.destination_dir)
+            os.makedirs(self.destination_dir)
+
+        jobs = [(rendition, self.destination_dir, force_overwrite, linear) for rendition in renditions]
+
+        if self.processes == 1 or len(jobs) == 1:
+            packaged_renditions = map(package_rendition, jobs)
+        else:
+            pool = multiprocessing.Pool(processes=self.processes or min(len(jobs), multiprocessing.cpu_count()))
+            try:
+                packaged_renditions = pool.map(package_rendition, jobs)
+            finally:
+                pool.close()
+                pool.join()
+
+        manifest_filename = os.path.join(self.destination_dir, self.asset_name + ".f4m")
+        write_atomically(manifest_filename, self.build_set_manifest(packaged_renditions))
+
+        return packaged_renditions
+
+    def build_set_manifest(self, packaged_renditions):
+        """ Returns a set-level .f4m referencing each stream-level .f4m """
+
+        manifest = ElementTree.Element("manifest", xmlns=F4M_2_NAMESPACE)
+
+        for packaged_rendition in sorted(packaged_renditions, key=lambda pr: pr.bitrate):
+            ElementTree.SubElement(manifest, "media", bitrate=str(packaged_rendition.bitrate),
+                                   href=os.path.basename(packaged_rendition.manifest_filename))
+
+        return _to_xml(manifest)
+
+def _to_xml(element):
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' + ElementTree.tostring(element)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Package every bitrate of an HDS asset: fragments, bootstraps and .f4m manifests')
+    parser.add_argument('segment', metavar='SEGMENT_FILE', nargs='+',
+                       help='Segment (.f4x) files of all renditions. Grouped into renditions by stream name')
+
+    parser.add_argument('-a', "--asset", dest="asset_name", required=True,
+                        help="Asset name, used for the set-level .f4m")
+
+    parser.add_argument('-b', "--bitrate", dest="bitrates", action="append", default=[],
+                        metavar="STREAM_NAME=KBPS",
+                        help="Bitrate of a rendition. Estimated from its size when not given")
+
+    parser.add_argument('-p', "--processes", dest="processes", type=int, default=None,
+                        help="Renditions to package in parallel (default: one per rendition, up to the CPU count)")
+
+    parser.add_argument("-F", '--force-overwrite', dest="force_overwrite", action="store_true",
+                        default=False,
+                        help="Overwrite fragments")
+
+    parser.add_argument("-L", '--linear', dest="linear", action="store_true",
+                        default=False,
+                        help="Read each f4f once, sequentially, instead of seeking to each fragment")
+
+    parser.add_argument('-d', "--destination", dest="destination_dir",
+                        default=".",
+                        help="Destination directory (default: %(default)s)")
+
+    parser.add_argument('-D', "--debug", dest="debug", action="store_true",
+                        default=False,
+                        help="Enable debug")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    bitrates = dict((stream_name, int(kbps)) for stream_name, kbps in
+                    (bitrate.split("=", 1) for bitrate in args.bitrates))
+
+    packager = HDSPackager(asset_name=args.asset_name, destination_dir=args.destination_dir,
+                           processes=args.processes)
+
+    for packaged_rendition in packager.package(group_renditions(args.segment, bitrates),
+                                               force_overwrite=args.force_overwrite, linear=args.linear):
+        logging.info("Packaged {stream_name} at {bitrate}kbps ({duration:.3f}s)".format(**packaged_rendition._asdict()))
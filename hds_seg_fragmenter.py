@@ -7,10 +7,13 @@
 
 import logging
 import os.path
-from f4v import F4VParser, FragmentRandomAccessBox
+from f4v import F4VParser, FragmentRandomAccessBox, F4VParserException, ProfilingTracer, LARGE_FILE_SIZE
+from fragment_index import FragmentHasher, FragmentIndex
+from timeit import default_timer
 from collections import namedtuple
 import tempfile
 import shutil
+import io
 
 class NullHandler(logging.Handler):
     def emit(self, record):
@@ -20,7 +23,12 @@ log = logging.getLogger(__name__)
 log.addHandler(NullHandler())
 log.setLevel(logging.FATAL)
 
-HDSFragment = namedtuple("HDSFragment", ["number", "segment_number", "data"])
+LINEAR_READ_BUFFER_SIZE = 4 * 1024 * 1024
+FRAGMENT_READ_CHUNK_SIZE = 256 * 1024
+
+HDSFragment = namedtuple("HDSFragment", ["number", "segment_number", "data", "digest"])
+QuarantinedFragment = namedtuple("QuarantinedFragment", ["number", "segment_number", "afra_offset", "reason"])
+F4FLayout = namedtuple("F4FLayout", ["boxes", "file_size"])
 
 class HDSSegSplitterException(Exception):
     pass
@@ -28,8 +36,14 @@ class HDSSegSplitterException(Exception):
 class HDSSegSplitter(object):
     """ Splits a segment into parts """
     
-    def __init__(self, f4x_filename, f4f_filename=None):
+    def __init__(self, f4x_filename, f4f_filename=None, tracer=None, large_file=None):
+        """ tracer is an optional f4v.ParseTracer, which receives parse and
+        read timings.
+        
+        large_file reads the f4f with plain seeks and reads and never maps it
+        into a bitstring. By default it's used for f4f files larger than 4GB """
         self.f4x_filename = f4x_filename
+        self.tracer = tracer
         
         (path, basename_with_ext) = os.path.split(f4x_filename)
         basename = os.path.splitext(basename_with_ext)[0]
@@ -45,55 +59,270 @@ class HDSSegSplitter(object):
         # ensure .f4f exists
         if not os.path.exists(self.f4f_filename):
             raise HDSSegSplitterException("f4f not found (%s)" % self.f4f_filename)
+        
+        if large_file is None:
+            large_file = os.path.getsize(self.f4f_filename) > LARGE_FILE_SIZE
+        self.large_file = large_file
+        
+        self.time_scale = None
+        self._global_entries = None
+        # filled by split() and split_linear() as they go
+        self.quarantined = []
 
-    def split(self):
-        """ Returns iterator of Fragments, containing frag number and bytes """
-        
-        f4v_parser = F4VParser()
-        f4x_boxes = f4v_parser.parse(filename=self.f4x_filename)
-       
-        # Find afra boxes in f4x index 
-        for box in f4x_boxes:
-            if isinstance(box, FragmentRandomAccessBox):
-                for fe in box.global_access_entries:
-                    log.debug("global afra: %s", fe)
-                    # get reference to afra in f4f
-                    log.debug("f4f afra lookup offset: %d", fe.afra_offset)             
-                    
-                    
-                    required_box_order = ["afra", "abst", "moof", "mdat"]
-                    offset_counter = 0
+    REQUIRED_BOX_ORDER = ["afra", "abst", "moof", "mdat"]
+
+    def split(self, verify=False):
+        """ Returns iterator of Fragments, containing frag number and bytes.
+        
+        When verify is True, each global afra entry is cross-checked against a
+        single header scan of the f4f instead of being re-parsed. Bad entries
+        are added to self.quarantined, with a reason, and valid fragments are
+        still returned """
+        
+        self.quarantined = []
+        
+        f4v_parser = F4VParser(tracer=self.tracer, large_file=self.large_file)
+        
+        if verify:
+            f4f_layout = self._scan_f4f_layout(f4v_parser)
+        
+        for fe in self.global_access_entries(f4v_parser):
+            log.debug("global afra: %s", fe)
+            # get reference to afra in f4f
+            log.debug("f4f afra lookup offset: %d", fe.afra_offset)
+            
+            if verify:
+                offset_counter, reason = self._verify_fragment_layout(f4f_layout, fe.afra_offset)
+                
+                if reason:
+                    self._quarantine(fe, reason)
+                    continue
+            else:
+                offset_counter = self._read_fragment_length(f4v_parser, fe.afra_offset)
+            
+            hasher = FragmentHasher()
+            if self.tracer is not None:
+                read_start = default_timer()
+            
+            hds_fragment_data = self._get_byterange(self.f4f_filename, fe.afra_offset, offset_counter, hasher)
+            
+            if self.tracer is not None:
+                self.tracer.bytes_read(self.f4f_filename, offset_counter, default_timer() - read_start)
+            fragment = HDSFragment(number=fe.fragment_number, segment_number=fe.segment_number, data=hds_fragment_data,
+                                   digest=hasher.digest()) 
+            yield fragment
+    
+    def split_linear(self, verify=False):
+        """ Returns iterator of Fragments in .f4f file order.
+        
+        Rather than parsing the f4f once per global afra entry, the f4f is
+        read once front to back with large sequential reads. Each afra, abst,
+        moof, mdat group is recognised by its box headers and matched to the
+        f4x entries by offset. verify behaves as it does for split() """
+        
+        self.quarantined = []
+        
+        f4v_parser = F4VParser(tracer=self.tracer, large_file=self.large_file)
+        entries_by_offset = dict((fe.afra_offset, fe) for fe in self.global_access_entries(f4v_parser))
+        
+        with io.open(self.f4f_filename, "rb", buffering=LINEAR_READ_BUFFER_SIZE) as f4f:
+            self._advise_sequential(f4f)
+            file_size = os.fstat(f4f.fileno()).st_size
+            
+            offset = 0
+            fe = None
+            
+            while offset < file_size:
+                if self.tracer is not None:
+                    header_start = default_timer()
+                
+                try:
+                    header = f4v_parser._read_file_box_header(f4f)
+                except F4VParserException as e:
+                    log.warn("Stopped reading %s: %s", self.f4f_filename, e)
+                    break
+                
+                if self.tracer is not None:
+                    self.tracer.header_scanned(self.f4f_filename, header.header_size, default_timer() - header_start)
+                
+                box_length = header.header_size + header.box_size
+                
+                if fe is not None and header.box_type != required_box_order[0]:
+                    self._reject(fe, "Expected %s at offset %d, found %s" % (required_box_order[0], offset, header.box_type), verify)
+                    fe = None
+                
+                if fe is None and offset in entries_by_offset:
+                    fe = entries_by_offset.pop(offset)
+                    required_box_order = list(self.REQUIRED_BOX_ORDER)
+                    fragment_parts = []
+                    hasher = FragmentHasher()
+                
+                if fe is not None:
+                    required_boxtype = required_box_order.pop(0)
                     
-                    for frag_box in f4v_parser.parse(filename=self.f4f_filename,
-                                                       offset_bytes=fe.afra_offset):
+                    if header.box_type != required_boxtype:
+                        self._reject(fe, "Expected %s at offset %d, found %s" % (required_boxtype, offset, header.box_type), verify)
+                        fe = None
+                    elif offset + box_length > file_size:
+                        self._reject(fe, "%s at offset %d is truncated" % (required_boxtype, offset), verify)
+                        fe = None
+                    else:
+                        if self.tracer is not None:
+                            read_start = default_timer()
                         
-                        # check for afra, abst, moof, mdat
-                        required_boxtype = required_box_order.pop(0)
-                        log.debug("Next required box type: %s", required_boxtype)
-                        log.debug("This box type: %s", frag_box.header.box_type)
+                        f4f.seek(offset)
+                        box_data = f4f.read(box_length)
+                        hasher.update(box_data)
                         
-                        if frag_box.header.box_type != required_boxtype:
-                            raise HDSSegSplitterException("HDS Fragment composition incorrect in: %s" % self.f4f_filename)
+                        if self.tracer is not None:
+                            self.tracer.bytes_read(self.f4f_filename, box_length, default_timer() - read_start)
+                        fragment_parts.append(box_data)
                         
-                        # count bytes from fe.afra_offset
-                        offset_counter += (frag_box.header.box_size + frag_box.header.header_size) 
-                        
-                        if frag_box.header.box_type == "mdat": 
-                            break
-                    
-                    hds_fragment_data = self._get_byterange(self.f4f_filename, fe.afra_offset, offset_counter)
-                    fragment = HDSFragment(number=fe.fragment_number, segment_number=fe.segment_number, data=hds_fragment_data) 
-                    yield fragment
-                    
-            else:
-                raise HDSSegSplitterException("No global_access_entries found. Possibly not an .f4x input file")   
+                        if not required_box_order:
+                            yield HDSFragment(number=fe.fragment_number, segment_number=fe.segment_number,
+                                              data=b"".join(fragment_parts), digest=hasher.digest())
+                            fe = None
+                
+                offset += box_length
+                f4f.seek(offset)
+            
+            if fe is not None:
+                self._reject(fe, "Fragment at offset %d is incomplete" % fe.afra_offset, verify)
+        
+        # Anything left over wasn't on a box boundary
+        for afra_offset in sorted(entries_by_offset):
+            self._reject(entries_by_offset[afra_offset], "afra_offset %d is not the start of a box" % afra_offset, verify)
+    
+    def _advise_sequential(self, f4f):
+        """ Hint to the kernel that it should read ahead aggressively """
+        posix_fadvise = getattr(os, "posix_fadvise", None)
+        if posix_fadvise:
+            posix_fadvise(f4f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    
+    def _reject(self, fe, reason, verify):
+        if verify:
+            self._quarantine(fe, reason)
+        else:
+            raise HDSSegSplitterException("HDS Fragment composition incorrect in: %s (%s)" % (self.f4f_filename, reason))
+    
+    def global_access_entries(self, f4v_parser=None):
+        """ Returns the global afra entries from the f4x index. The index is
+        only parsed once per splitter, so it can be shared with other stages """
+        
+        if self._global_entries is None:
+            f4v_parser = f4v_parser or F4VParser(tracer=self.tracer, large_file=self.large_file)
+            f4x_boxes = f4v_parser.parse(filename=self.f4x_filename)
+            global_entries = []
+           
+            # Find afra boxes in f4x index 
+            for box in f4x_boxes:
+                if isinstance(box, FragmentRandomAccessBox):
+                    self.time_scale = box.time_scale
+                    global_entries.extend(box.global_access_entries)
+                else:
+                    raise HDSSegSplitterException("No global_access_entries found. Possibly not an .f4x input file")
+            
+            self._global_entries = global_entries
+        
+        return self._global_entries
+    
+    def _read_fragment_length(self, f4v_parser, afra_offset):
+        """ Parses the f4f from afra_offset and returns the length of the
+        afra, abst, moof, mdat group """
+        
+        required_box_order = list(self.REQUIRED_BOX_ORDER)
+        offset_counter = 0
+        
+        if self.large_file:
+            # only the headers are needed, not the mdat payload
+            frag_headers = (header for _, header in f4v_parser.scan_headers(self.f4f_filename, offset_bytes=afra_offset))
+        else:
+            frag_headers = (frag_box.header for frag_box in f4v_parser.parse(filename=self.f4f_filename,
+                                                                             offset_bytes=afra_offset))
+        
+        try:
+            for frag_header in frag_headers:
+                
+                # check for afra, abst, moof, mdat
+                required_boxtype = required_box_order.pop(0)
+                log.debug("Next required box type: %s", required_boxtype)
+                log.debug("This box type: %s", frag_header.box_type)
+                
+                if frag_header.box_type != required_boxtype:
+                    raise HDSSegSplitterException("HDS Fragment composition incorrect in: %s" % self.f4f_filename)
+                
+                # count bytes from afra_offset
+                offset_counter += (frag_header.box_size + frag_header.header_size) 
+                
+                if frag_header.box_type == "mdat": 
+                    break
+        except F4VParserException as e:
+            raise HDSSegSplitterException("HDS Fragment composition incorrect in: %s (%s)" % (self.f4f_filename, e))
+        
+        return offset_counter
+    
+    def _scan_f4f_layout(self, f4v_parser):
+        """ Maps box offsets to headers with one sequential header scan of the f4f.
+        A truncated trailing header (e.g. a live segment mid-write) ends the scan """
+        
+        f4f_layout = {}
+        
+        try:
+            for offset, header in f4v_parser.scan_headers(self.f4f_filename):
+                f4f_layout[offset] = header
+        except F4VParserException as e:
+            log.warn("Stopped scanning %s: %s", self.f4f_filename, e)
+        
+        return F4FLayout(boxes=f4f_layout, file_size=os.path.getsize(self.f4f_filename))
+    
+    def _verify_fragment_layout(self, f4f_layout, afra_offset):
+        """ Checks that an afra, abst, moof, mdat group starts at afra_offset.
+        Returns (fragment length, None) or (None, reason) """
+        
+        offset = afra_offset
+        
+        for required_boxtype in self.REQUIRED_BOX_ORDER:
+            header = f4f_layout.boxes.get(offset)
+            
+            if header is None:
+                if offset == afra_offset:
+                    return None, "afra_offset %d is not the start of a box" % afra_offset
+                return None, "No box at offset %d (expected %s)" % (offset, required_boxtype)
+            
+            if header.box_type != required_boxtype:
+                return None, "Expected %s at offset %d, found %s" % (required_boxtype, offset, header.box_type)
+            
+            offset += header.header_size + header.box_size
+            
+            if offset > f4f_layout.file_size:
+                return None, "%s at offset %d is truncated" % (required_boxtype, offset - header.header_size - header.box_size)
+        
+        return offset - afra_offset, None
+    
+    def _quarantine(self, fe, reason):
+        log.warn("Quarantining fragment %d of segment %d in %s: %s", fe.fragment_number, 
+                    fe.segment_number, self.f4f_filename, reason)
+        self.quarantined.append(QuarantinedFragment(number=fe.fragment_number,
+                                                    segment_number=fe.segment_number,
+                                                    afra_offset=fe.afra_offset,
+                                                    reason=reason))
                     
-    def create_file_fragments(self, destination_dir, force_overwrite=False):
+    def create_file_fragments(self, destination_dir, force_overwrite=False, verify=False, linear=False,
+                              fragment_index=None):
+        """ Writes fragments to destination_dir. When a FragmentIndex is given,
+        fragments already written with the same content are never rewritten,
+        even with force_overwrite """
+        
         if not os.path.exists(destination_dir):
             log.info("Creating destination directory: %s", destination_dir)
             os.makedirs(destination_dir)
         
-        for fragment in self.split():
+        if linear:
+            fragments = self.split_linear(verify=verify)
+        else:
+            fragments = self.split(verify=verify)
+        
+        for fragment in fragments:
             fragment_filename = "{stream_name}Seg{segment_number}-Frag{fragment_number}".format(stream_name=self.stream_name,
                                                                                                 segment_number=fragment.segment_number,
                                                                                                 fragment_number=fragment.number)
@@ -101,9 +330,15 @@ class HDSSegSplitter(object):
             log.debug("fragment_filename: %s", fragment_filename)
             log.debug("fragment_fqdn_filename: %s", fragment_fqdn_filename)
             
-            if os.path.exists(fragment_fqdn_filename) and not force_overwrite:
-                log.info("%s already exists. Not overwriting", fragment_fqdn_filename)
-                continue
+            if os.path.exists(fragment_fqdn_filename):
+                if fragment_index is not None and fragment_index.is_unchanged(fragment_filename, fragment.digest) and \
+                        os.path.getsize(fragment_fqdn_filename) == fragment.digest.size:
+                    log.info("%s is unchanged. Not overwriting", fragment_fqdn_filename)
+                    continue
+                
+                if not force_overwrite:
+                    log.info("%s already exists. Not overwriting", fragment_fqdn_filename)
+                    continue
             
             temp_frag = tempfile.NamedTemporaryFile(dir=destination_dir, delete=False)
             log.debug("Created tempfile for writing: %s", temp_frag.name)
@@ -114,12 +349,30 @@ class HDSSegSplitter(object):
             log.info("Moving temp file (%s) to: %s", temp_frag.name, fragment_fqdn_filename)
             shutil.move(temp_frag.name, fragment_fqdn_filename)
             
+            if fragment_index is not None:
+                fragment_index.record(fragment_filename, fragment.digest)
+            
                     
-    def _get_byterange(self, filename, start, end):
-        my_file = open(filename, "rb")
-        my_file.seek(start)
-        data = my_file.read(end)
-        return data
+    def _get_byterange(self, filename, start, length, hasher=None):
+        """ Returns length bytes from start. Reads in chunks, hashing as it
+        goes rather than in a second pass """
+        
+        with open(filename, "rb") as my_file:
+            my_file.seek(start)
+            
+            chunks = []
+            remaining = length
+            while remaining > 0:
+                chunk = my_file.read(min(remaining, FRAGMENT_READ_CHUNK_SIZE))
+                if not chunk:
+                    raise HDSSegSplitterException("Short read of %s: %d of %d bytes from offset %d" % 
+                                                  (filename, length - remaining, length, start))
+                if hasher is not None:
+                    hasher.update(chunk)
+                chunks.append(chunk)
+                remaining -= len(chunk)
+            
+            return b"".join(chunks)
                         
 
 if __name__ == "__main__":
@@ -134,6 +387,18 @@ if __name__ == "__main__":
                         default=False,
                         help="Overwrite fragments")
     
+    parser.add_argument("-V", '--verify', dest="verify", action="store_true",
+                        default=False,
+                        help="Cross-check f4x offsets against the f4f and skip bad fragments instead of aborting")
+    
+    parser.add_argument("-L", '--linear', dest="linear", action="store_true",
+                        default=False,
+                        help="Read the f4f once, sequentially, instead of seeking to each fragment")
+    
+    parser.add_argument("-I", '--index', dest="index_filename",
+                        default=None,
+                        help="Fragment digest index. Fragments whose content is unchanged are not rewritten")
+    
     parser.add_argument('-d', "--destination", dest="destination_dir",
                         default=".",
                         help="Destination directory (default: %(default)s)")
@@ -145,6 +410,14 @@ if __name__ == "__main__":
     parser.add_argument('-Q', "--quiet", dest="quiet", action="store_true",
                         default=False,
                         help="Quite mode (WARNING)")
+    
+    parser.add_argument('-P', "--profile", dest="profile", action="store_true",
+                        default=False,
+                        help="Print the time spent per box type")
+    
+    parser.add_argument('-G', "--large-file", dest="large_file", action="store_true",
+                        default=None,
+                        help="Read the f4f with plain seeks and reads (default: only for f4f files over 4GB)")
 
     
     args = parser.parse_args()
@@ -158,11 +431,21 @@ if __name__ == "__main__":
 
     logging.basicConfig(level=log_level)
 
+    fragment_index = FragmentIndex(args.index_filename) if args.index_filename else None
+    tracer = ProfilingTracer() if args.profile else None
+    
     # Iterate over segments defined on command line
     for segment_file in args.segment:
         
         if os.path.splitext(segment_file)[1] != ".f4x":
             logging.warn("Segment file given ({segment}) does not have a .f4x extension".format(segment=segment_file))
         
-        splitter = HDSSegSplitter(segment_file)
-        splitter.create_file_fragments(destination_dir=args.destination_dir, force_overwrite=args.force_overwrite)
\ No newline at end of file
+        splitter = HDSSegSplitter(segment_file, tracer=tracer, large_file=args.large_file)
+        splitter.create_file_fragments(destination_dir=args.destination_dir, force_overwrite=args.force_overwrite,
+                                       verify=args.verify, linear=args.linear, fragment_index=fragment_index)
+        
+        for quarantined in splitter.quarantined:
+            logging.warn("Skipped fragment {number} of segment {segment_number}: {reason}".format(**quarantined._asdict()))
+    
+    if tracer:
+        print tracer.report()
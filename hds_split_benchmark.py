@@ -0,0 +1,189 @@
+""" Benchmarks the HDSSegSplitter split strategies against each other.
+
+Uses a synthetic segment unless .f4x files are given. With --large, a sparse
+synthetic segment larger than 4GB is split and the throughput before and
+after the 4GB mark is compared.
+
+@author: Alastair McCormack
+@license: MIT License
+
+"""
+
+import logging
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from hds_seg_fragmenter import HDSSegSplitter
+from f4v import LARGE_FILE_SIZE
+from f4v_writer import SyntheticSegmentWriter
+
+BenchmarkResult = namedtuple("BenchmarkResult", ["strategy", "seconds", "fragment_count", "byte_count"])
+
+STRATEGIES = ["split", "split_linear"]
+
+# --large segments end this far past the 4GB mark
+LARGE_SEGMENT_MARGIN = 512 * 1024 * 1024
+
+# --large fails when throughput past the 4GB mark falls below this fraction of
+# the throughput before it
+DEFAULT_MIN_RATIO = 0.8
+
+def write_synthetic_segment(directory, fragment_count, mdat_size, sparse=False, long_size=False):
+    """ Writes a synthetic segment and returns the .f4x filename """
+
+    f4x_filename = os.path.join(directory, "benchmarkSeg1.f4x")
+    f4f_filename = os.path.join(directory, "benchmarkSeg1.f4f")
+
+    segment_writer = SyntheticSegmentWriter(f4x_filename, f4f_filename, mdat_size=mdat_size, long_size=long_size)
+    for _ in xrange(fragment_count):
+        segment_writer.append_fragment(sparse=sparse)
+    segment_writer.write_index()
+
+    return f4x_filename
+
+def benchmark_strategy(f4x_filename, strategy, repeat=1):
+    """ Returns the best of repeat runs of a split strategy """
+
+    best = None
+
+    for _ in xrange(repeat):
+        splitter = HDSSegSplitter(f4x_filename)
+        fragment_count = 0
+        byte_count = 0
+
+        start = time.time()
+        for fragment in getattr(splitter, strategy)():
+            fragment_count += 1
+            byte_count += len(fragment.data)
+        seconds = time.time() - start
+
+        if best is None or seconds < best.seconds:
+            best = BenchmarkResult(strategy=strategy, seconds=seconds,
+                                   fragment_count=fragment_count, byte_count=byte_count)
+
+    return best
+
+def benchmark_across_boundary(f4x_filename, strategy, boundary=LARGE_FILE_SIZE):
+    """ Returns a BenchmarkResult for the fragments before boundary and one
+    for those after it. Each fragment is timed from request to delivery """
+
+    splitter = HDSSegSplitter(f4x_filename)
+    afra_offsets = dict((fe.fragment_number, fe.afra_offset) for fe in splitter.global_access_entries())
+
+    # [seconds, fragment count, byte count], before and after boundary
+    totals = {False: [0.0, 0, 0], True: [0.0, 0, 0]}
+    fragments = getattr(splitter, strategy)()
+
+    while True:
+        start = time.time()
+        try:
+            fragment = next(fragments)
+        except StopIteration:
+            break
+        seconds = time.time() - start
+
+        total = totals[afra_offsets[fragment.number] >= boundary]
+        total[0] += seconds
+        total[1] += 1
+        total[2] += len(fragment.data)
+
+    return [BenchmarkResult(strategy="%s %s4GB" % (strategy, ">" if past_boundary else "<"),
+                            seconds=totals[past_boundary][0], fragment_count=totals[past_boundary][1],
+                            byte_count=totals[past_boundary][2])
+            for past_boundary in (False, True)]
+
+def format_result(result):
+    return "{strategy:>18}: {seconds:8.3f}s {fragments_per_second:10.1f} frags/s {mb_per_second:8.1f} MB/s".format(
+                strategy=result.strategy, seconds=result.seconds,
+                fragments_per_second=result.fragment_count / max(result.seconds, 1e-9),
+                mb_per_second=result.byte_count / max(result.seconds, 1e-9) / (1024 * 1024))
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare the per-entry and linear split strategies')
+    parser.add_argument('segment', metavar='SEGMENT_FILE', nargs='*',
+                       help='Segment (.f4x) files (default: a synthetic segment)')
+
+    parser.add_argument("-n", '--fragments', dest="fragment_count", type=int,
+                        default=500,
+                        help="Fragments in the synthetic segment (default: %(default)s)")
+
+    parser.add_argument("-s", '--mdat-size', dest="mdat_size", type=int,
+                        default=500 * 1024,
+                        help="mdat payload bytes per synthetic fragment (default: %(default)s)")
+
+    parser.add_argument("-r", '--repeat', dest="repeat", type=int,
+                        default=3,
+                        help="Runs per strategy. The best is reported (default: %(default)s)")
+
+    parser.add_argument("-l", '--large', dest="large", action="store_true",
+                        default=False,
+                        help="Use a sparse synthetic segment larger than 4GB, with 64-bit mdat sizes, and compare the "
+                             "throughput either side of the 4GB mark. --fragments is raised as needed")
+
+    parser.add_argument("-m", '--min-ratio', dest="min_ratio", type=float,
+                        default=DEFAULT_MIN_RATIO,
+                        help="With --large, exit non-zero if the after / before throughput ratio of any strategy "
+                             "is below this (default: %(default)s)")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    temp_dir = None
+    failed = False
+    segment_files = args.segment
+
+    if args.large:
+        args.fragment_count = max(args.fragment_count, (LARGE_FILE_SIZE + LARGE_SEGMENT_MARGIN) // args.mdat_size + 1)
+
+    if not segment_files:
+        temp_dir = tempfile.mkdtemp()
+        logging.info("Writing synthetic segment of %d fragments to %s", args.fragment_count, temp_dir)
+        segment_files = [write_synthetic_segment(temp_dir, args.fragment_count, args.mdat_size,
+                                                 sparse=args.large, long_size=args.large)]
+
+    try:
+        for segment_file in segment_files:
+            print segment_file
+
+            # (fragment count, byte count) of each strategy
+            fragment_totals = set()
+
+            if args.large:
+                for strategy in STRATEGIES:
+                    before, after = benchmark_across_boundary(segment_file, strategy)
+                    print format_result(before)
+                    print format_result(after)
+
+                    if before.fragment_count and after.fragment_count:
+                        ratio = (after.byte_count / max(after.seconds, 1e-9)) / (before.byte_count / max(before.seconds, 1e-9))
+                        print "{0:>18}: {1:8.2f}x".format("after / before", ratio)
+
+                        if ratio < args.min_ratio:
+                            logging.warn("%s throughput past 4GB is %.2fx of that before it (minimum %.2fx)",
+                                         strategy, ratio, args.min_ratio)
+                            failed = True
+
+                    fragment_totals.add((before.fragment_count + after.fragment_count, before.byte_count + after.byte_count))
+            else:
+                for strategy in STRATEGIES:
+                    result = benchmark_strategy(segment_file, strategy, args.repeat)
+                    print format_result(result)
+                    fragment_totals.add((result.fragment_count, result.byte_count))
+
+            if len(fragment_totals) != 1:
+                logging.warn("Strategies disagree on the fragments in %s", segment_file)
+                failed = True
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir)
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,119 @@
+""" Tests of bootstrap comparison and publishing. Run with:
+python -m unittest discover
+
+@author: Alastair McCormack
+@license: MIT License
+
+"""
+
+import pickle
+import unittest
+from bootstrap_diff import (BootstrapPublisher, BootstrapDiffException, prepare_bootstrap, parse_bootstrap,
+                            live_edge, LiveEdge)
+from f4v import BootStrapInfoBox, SegmentRunTable, FragmentRunTable
+from f4v_writer import F4VWriter, from_timescale
+
+TIME_SCALE = 1000
+FRAGMENT_DURATION = 4000
+
+def bootstrap_payload(fragment_count, first_fragment=1):
+    """ Returns a live .bootstrap whose live edge is fragment fragment_count """
+
+    asrt = SegmentRunTable()
+    asrt.update = False
+    asrt.quality_segment_url_modifiers = []
+    asrt.segment_run_table_entries = [SegmentRunTable.SegmentRunTableEntry(first_segment=1, fragments_per_segment=1000)]
+
+    afrt = FragmentRunTable()
+    afrt.update = False
+    afrt.time_scale = TIME_SCALE
+    afrt.quality_fragment_url_modifiers = []
+    afrt.fragments = [FragmentRunTable.FragmentRunTableEntry(
+                        first_fragment=first_fragment,
+                        first_fragment_timestamp=from_timescale((first_fragment - 1) * FRAGMENT_DURATION, TIME_SCALE),
+                        fragment_duration=FRAGMENT_DURATION, discontinuity_indicator=None)]
+
+    abst = BootStrapInfoBox()
+    abst.version = fragment_count
+    abst.profile_raw = 0
+    abst.live = True
+    abst.update = False
+    abst.time_scale = TIME_SCALE
+    abst.current_media_time = fragment_count * FRAGMENT_DURATION
+    abst.smpte_timecode_offset = 0
+    abst.movie_identifier = None
+    abst.server_entry_table = []
+    abst.quality_entry_table = []
+    abst.drm_data = None
+    abst.meta_data = None
+    abst.segment_run_tables = [asrt]
+    abst.fragment_tables = [afrt]
+
+    return F4VWriter().abst(abst)
+
+
+class BootstrapPublisherTest(unittest.TestCase):
+
+    def test_first_bootstrap_is_published(self):
+        prepared_bootstrap = BootstrapPublisher().publishable_bootstrap("s.bootstrap", bootstrap_payload(5))
+        self.assertEqual(prepared_bootstrap.publish_payload, bootstrap_payload(5))
+        self.assertEqual(prepared_bootstrap.snapshot.live_edge, LiveEdge(segment_number=1, fragment_number=5))
+
+    def test_identical_bootstrap_is_skipped(self):
+        bootstrap_publisher = BootstrapPublisher()
+        bootstrap_publisher.publishable_bootstrap("s.bootstrap", bootstrap_payload(5))
+        self.assertEqual(bootstrap_publisher.publishable_bootstrap("s.bootstrap", bootstrap_payload(5)), None)
+
+    def test_live_edge_moving_forward_is_published(self):
+        bootstrap_publisher = BootstrapPublisher()
+        bootstrap_publisher.publishable_bootstrap("s.bootstrap", bootstrap_payload(5))
+        self.assertNotEqual(bootstrap_publisher.publishable_bootstrap("s.bootstrap", bootstrap_payload(6)), None)
+
+    def test_older_bootstrap_is_not_published(self):
+        bootstrap_publisher = BootstrapPublisher()
+        bootstrap_publisher.publishable_bootstrap("s.bootstrap", bootstrap_payload(6))
+
+        self.assertEqual(bootstrap_publisher.publishable_bootstrap("s.bootstrap", bootstrap_payload(5)), None)
+        # and the newer one is still the one compared against
+        self.assertEqual(bootstrap_publisher.publishable_bootstrap("s.bootstrap", bootstrap_payload(6)), None)
+        self.assertNotEqual(bootstrap_publisher.publishable_bootstrap("s.bootstrap", bootstrap_payload(7)), None)
+
+    def test_older_bootstrap_prepared_late_is_not_published(self):
+        """ Two threads prepare bootstraps 5 and 6, and 6 wins the race """
+
+        bootstrap_publisher = BootstrapPublisher()
+        older = prepare_bootstrap(bootstrap_payload(5))
+        newer = prepare_bootstrap(bootstrap_payload(6))
+
+        self.assertTrue(bootstrap_publisher.should_publish("s.bootstrap", newer))
+        self.assertFalse(bootstrap_publisher.should_publish("s.bootstrap", older))
+
+    def test_changed_runs_are_published(self):
+        bootstrap_publisher = BootstrapPublisher()
+        bootstrap_publisher.publishable_bootstrap("s.bootstrap", bootstrap_payload(6))
+        self.assertNotEqual(bootstrap_publisher.publishable_bootstrap("s.bootstrap", bootstrap_payload(6, first_fragment=2)),
+                            None)
+
+    def test_streams_are_compared_separately(self):
+        bootstrap_publisher = BootstrapPublisher()
+        bootstrap_publisher.publishable_bootstrap("a.bootstrap", bootstrap_payload(6))
+        self.assertNotEqual(bootstrap_publisher.publishable_bootstrap("b.bootstrap", bootstrap_payload(5)), None)
+
+    def test_incomplete_bootstrap_raises(self):
+        self.assertRaises(BootstrapDiffException, BootstrapPublisher().publishable_bootstrap, "s.bootstrap",
+                          bootstrap_payload(5)[:-10])
+
+    def test_dvr_window_is_trimmed(self):
+        prepared_bootstrap = BootstrapPublisher(dvr_window=20).publishable_bootstrap("s.bootstrap", bootstrap_payload(100))
+        abst = parse_bootstrap(prepared_bootstrap.publish_payload)
+
+        self.assertEqual(abst.fragment_tables[0].fragments[0].first_fragment, 96)
+        self.assertEqual(live_edge(abst).fragment_number, 100)
+
+    def test_prepared_bootstrap_can_be_pickled(self):
+        prepared_bootstrap = prepare_bootstrap(bootstrap_payload(5), dvr_window=8)
+        self.assertEqual(pickle.loads(pickle.dumps(prepared_bootstrap, pickle.HIGHEST_PROTOCOL)), prepared_bootstrap)
+
+
+if __name__ == "__main__":
+    unittest.main()
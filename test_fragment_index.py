@@ -0,0 +1,86 @@
+""" Tests of the fragment digest index. Run with: python -m unittest discover
+
+@author: Alastair McCormack
+@license: MIT License
+
+"""
+
+import os.path
+import shutil
+import tempfile
+import unittest
+import fragment_index
+from fragment_index import FragmentIndex, digest_of
+
+class FragmentIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.index_filename = os.path.join(self.temp_dir, "index.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def journal_line_count(self):
+        with open(self.index_filename) as journal:
+            return sum(1 for _ in journal)
+
+    def test_unchanged(self):
+        index = FragmentIndex()
+        index.record("a", digest_of("one"))
+
+        self.assertTrue(index.is_unchanged("a", digest_of("one")))
+        self.assertFalse(index.is_unchanged("a", digest_of("two")))
+        self.assertFalse(index.is_unchanged("b", digest_of("one")))
+        self.assertFalse(index.is_unchanged("a", None))
+
+    def test_reloaded_from_journal(self):
+        index = FragmentIndex(self.index_filename)
+        index.record("a", digest_of("one"))
+        index.record("b", digest_of("two"))
+        index.record("a", digest_of("three"))
+
+        reloaded_index = FragmentIndex(self.index_filename)
+        self.assertEqual(len(reloaded_index), 2)
+        self.assertEqual(reloaded_index.get("a"), digest_of("three"))
+        self.assertEqual(reloaded_index.get("b"), digest_of("two"))
+        # compacted on load
+        self.assertEqual(self.journal_line_count(), 2)
+
+    def test_bad_journal_line_is_ignored(self):
+        FragmentIndex(self.index_filename).record("a", digest_of("one"))
+        with open(self.index_filename, "a") as journal:
+            journal.write('{"name": "b", "md5"')
+
+        reloaded_index = FragmentIndex(self.index_filename)
+        self.assertEqual(len(reloaded_index), 1)
+        self.assertEqual(reloaded_index.get("a"), digest_of("one"))
+
+    def test_maxlen_drops_oldest(self):
+        index = FragmentIndex(self.index_filename, maxlen=3)
+        for name in "abcd":
+            index.record(name, digest_of(name))
+        # recording again makes it the newest
+        index.record("b", digest_of("b"))
+        index.record("e", digest_of("e"))
+
+        self.assertEqual([index.get(name) is not None for name in "abcde"], [False, True, False, True, True])
+
+        reloaded_index = FragmentIndex(self.index_filename, maxlen=3)
+        self.assertEqual([reloaded_index.get(name) is not None for name in "abcde"], [False, True, False, True, True])
+
+    def test_journal_is_compacted(self):
+        index = FragmentIndex(self.index_filename, maxlen=10)
+        record_count = fragment_index.JOURNAL_COMPACT_MIN_LINES * 3
+
+        for n in xrange(record_count):
+            index.record("frag%d" % n, digest_of(str(n)))
+
+        self.assertEqual(len(index), 10)
+        self.assertTrue(self.journal_line_count() < fragment_index.JOURNAL_COMPACT_MIN_LINES)
+        self.assertEqual(FragmentIndex(self.index_filename).get("frag%d" % (record_count - 1)),
+                         digest_of(str(record_count - 1)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,224 @@
+""" Tests of 64-bit box sizes, mixed-width afra boxes and the large-file
+reading mode. Run with: python -m unittest discover
+
+@author: Alastair McCormack
+@license: MIT License
+
+"""
+
+import bitstring
+import itertools
+import os.path
+import shutil
+import struct
+import tempfile
+import unittest
+from f4v import F4VParser, F4VParserException, FragmentRandomAccessBox, LARGE_FILE_SIZE, ProfilingTracer
+from f4v_writer import F4VWriter, SyntheticSegmentWriter, from_timescale, MAX_UINT16, MAX_UINT32
+from hds_seg_fragmenter import HDSSegSplitter
+
+class TempDirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_file(self, name, data):
+        filename = os.path.join(self.temp_dir, name)
+        with open(filename, "wb") as f:
+            f.write(data)
+        return filename
+
+
+class BoxHeaderTest(TempDirTestCase):
+    """ Both header readers must agree on every kind of box size """
+
+    PAYLOAD = "x" * 100
+
+    def read_headers(self, data):
+        """ Returns the header as read by _read_box_header and by _read_file_box_header """
+
+        f4v_parser = F4VParser()
+        bs_header = f4v_parser._read_box_header(bitstring.ConstBitStream(bytes=data))
+
+        with open(self.write_file("box", data), "rb") as f:
+            file_header = f4v_parser._read_file_box_header(f)
+
+        return bs_header, file_header
+
+    def test_32_bit_size(self):
+        for header in self.read_headers(F4VWriter().box("free", self.PAYLOAD)):
+            self.assertEqual((header.box_type, header.header_size, header.box_size), ("free", 8, len(self.PAYLOAD)))
+
+    def test_64_bit_size(self):
+        for header in self.read_headers(F4VWriter().box("mdat", self.PAYLOAD, long_size=True)):
+            self.assertEqual((header.box_type, header.header_size, header.box_size), ("mdat", 16, len(self.PAYLOAD)))
+
+    def test_64_bit_size_above_4gb(self):
+        data = struct.pack(">I4sQ", 1, "mdat", MAX_UINT32 + 16 + 1)
+        f4v_parser = F4VParser()
+
+        header = f4v_parser._read_box_header(bitstring.ConstBitStream(bytes=data))
+        self.assertEqual(header.box_size, MAX_UINT32 + 1)
+
+        with open(self.write_file("box", data), "rb") as f:
+            self.assertEqual(f4v_parser._read_file_box_header(f).box_size, MAX_UINT32 + 1)
+
+    def test_size_zero_extends_to_end(self):
+        data = struct.pack(">I4s", 0, "mdat") + self.PAYLOAD
+        for header in self.read_headers(data):
+            self.assertEqual((header.box_type, header.header_size, header.box_size), ("mdat", 8, len(self.PAYLOAD)))
+
+    def test_size_zero_after_other_boxes(self):
+        data = F4VWriter().box("free", self.PAYLOAD) + struct.pack(">I4s", 0, "mdat") + self.PAYLOAD
+        boxes = list(F4VParser().parse(bytes_input=data))
+        self.assertEqual([box.header.box_type for box in boxes], ["free", "mdat"])
+        self.assertEqual(boxes[1].payload, self.PAYLOAD)
+
+    def test_size_smaller_than_header(self):
+        for data in (struct.pack(">I4s", 4, "free") + self.PAYLOAD,
+                     struct.pack(">I4sQ", 1, "free", 15) + self.PAYLOAD):
+            self.assertRaises(F4VParserException, F4VParser()._read_box_header, bitstring.ConstBitStream(bytes=data))
+
+            with open(self.write_file("box", data), "rb") as f:
+                self.assertRaises(F4VParserException, F4VParser()._read_file_box_header, f)
+
+    def test_truncated_header(self):
+        with open(self.write_file("box", struct.pack(">I4s", 1, "mdat") + "\x00" * 4), "rb") as f:
+            self.assertRaises(F4VParserException, F4VParser()._read_file_box_header, f)
+
+
+class MixedWidthAfraTest(TempDirTestCase):
+    """ Every combination of long_ids and long_offsets, parsed back with the
+    bitstring and large-file parsers """
+
+    TIME_SCALE = 1000
+
+    def entries(self, long_ids, long_offsets):
+        max_id = MAX_UINT16 + 1 if long_ids else MAX_UINT16
+        max_offset = MAX_UINT32 + 1 if long_offsets else MAX_UINT32
+
+        local_entries = [FragmentRandomAccessBox.FragmentRandomAccessBoxEntry(time=from_timescale(4000, self.TIME_SCALE),
+                                                                              offset=max_offset)]
+        global_entries = [FragmentRandomAccessBox.FragmentRandomAccessBoxGlobalEntry(
+                                            time=from_timescale(4000 * n, self.TIME_SCALE),
+                                            segment_number=1, fragment_number=max_id - n,
+                                            afra_offset=max_offset - n, sample_offset=n)
+                          for n in xrange(3)]
+        return local_entries, global_entries
+
+    def test_round_trip(self):
+        for long_ids, long_offsets in itertools.product((False, True), repeat=2):
+            local_entries, global_entries = self.entries(long_ids, long_offsets)
+            afra_filename = self.write_file("test.f4x", F4VWriter().afra(self.TIME_SCALE, global_entries=global_entries,
+                                                                         local_entries=local_entries,
+                                                                         long_ids=long_ids, long_offsets=long_offsets))
+
+            for large_file in (False, True):
+                boxes = list(F4VParser(large_file=large_file).parse(filename=afra_filename))
+                combination = "long_ids=%s long_offsets=%s large_file=%s" % (long_ids, long_offsets, large_file)
+
+                self.assertEqual(len(boxes), 1, combination)
+                self.assertEqual(boxes[0].time_scale, self.TIME_SCALE, combination)
+                self.assertEqual(boxes[0].local_access_entries, local_entries, combination)
+                self.assertEqual(boxes[0].global_access_entries, global_entries, combination)
+
+    def test_widths_are_picked_from_entries(self):
+        short_size = len(F4VWriter().afra(self.TIME_SCALE, global_entries=self.entries(False, False)[1]))
+        long_ids_size = len(F4VWriter().afra(self.TIME_SCALE, global_entries=self.entries(True, False)[1]))
+        long_offsets_size = len(F4VWriter().afra(self.TIME_SCALE, global_entries=self.entries(False, True)[1]))
+
+        # 3 entries, each with two ids or two offsets
+        self.assertEqual(long_ids_size - short_size, 3 * 2 * 2)
+        self.assertEqual(long_offsets_size - short_size, 3 * 2 * 4)
+
+
+class SplitStrategyTest(TempDirTestCase):
+    """ split, split(verify=True) and split_linear must return the same
+    fragments, whatever the box and afra field widths """
+
+    def write_segment(self, name, **writer_args):
+        f4x_filename = os.path.join(self.temp_dir, name + "Seg1.f4x")
+        segment_writer = SyntheticSegmentWriter(f4x_filename, os.path.join(self.temp_dir, name + "Seg1.f4f"),
+                                                mdat_size=3000, **writer_args)
+        for _ in xrange(5):
+            segment_writer.append_fragment()
+        segment_writer.write_index()
+        return f4x_filename
+
+    def split_all_ways(self, f4x_filename):
+        results = {}
+        for large_file in (False, True):
+            for strategy in ("split", "split_linear"):
+                for verify in (False, True):
+                    splitter = HDSSegSplitter(f4x_filename, large_file=large_file)
+                    fragments = [(fragment.segment_number, fragment.number, fragment.digest)
+                                 for fragment in getattr(splitter, strategy)(verify=verify)]
+                    self.assertEqual(splitter.quarantined, [])
+                    results[(large_file, strategy, verify)] = fragments
+        return results
+
+    def assert_strategies_agree(self, f4x_filename):
+        results = self.split_all_ways(f4x_filename)
+        expected = results[(False, "split", False)]
+
+        self.assertEqual([number for _, number, _ in expected], range(1, 6))
+        for key, fragments in results.items():
+            self.assertEqual(fragments, expected, "large_file=%s %s verify=%s" % key)
+
+    def test_long_size(self):
+        self.assert_strategies_agree(self.write_segment("longSize", long_size=True))
+
+    def test_mixed_width_index(self):
+        for long_ids, long_offsets in itertools.product((False, True), repeat=2):
+            self.assert_strategies_agree(self.write_segment("mixed%d%d" % (long_ids, long_offsets),
+                                                            long_size=True, long_ids=long_ids,
+                                                            long_offsets=long_offsets))
+
+    def test_verify_pass_is_profiled(self):
+        f4x_filename = self.write_segment("profiled")
+        f4f_size = os.path.getsize(HDSSegSplitter(f4x_filename).f4f_filename)
+
+        for strategy in ("split", "split_linear"):
+            tracer = ProfilingTracer()
+            list(getattr(HDSSegSplitter(f4x_filename, tracer=tracer), strategy)(verify=True))
+
+            # 5 fragments of afra, abst, moof and mdat
+            self.assertEqual(tracer.costs[ProfilingTracer.SCAN].count, 5 * 4, strategy)
+            self.assertEqual(tracer.costs[ProfilingTracer.READ].byte_size, f4f_size, strategy)
+
+    def test_fragment_past_4gb(self):
+        """ A sparse segment whose second fragment starts past 4GB. Only that
+        fragment is read, so the test stays cheap """
+
+        f4x_filename = os.path.join(self.temp_dir, "hugeSeg1.f4x")
+        segment_writer = SyntheticSegmentWriter(f4x_filename, os.path.join(self.temp_dir, "hugeSeg1.f4f"),
+                                                mdat_size=LARGE_FILE_SIZE)
+        segment_writer.append_fragment(sparse=True)
+        segment_writer.append_fragment(mdat_payload="y" * 3000)
+        segment_writer.write_index()
+
+        splitter = HDSSegSplitter(f4x_filename)
+        self.assertTrue(splitter.large_file)
+
+        f4v_parser = F4VParser(large_file=True)
+        first_entry, second_entry = splitter.global_access_entries(f4v_parser)
+        self.assertEqual(first_entry.afra_offset, 0)
+        self.assertTrue(second_entry.afra_offset > MAX_UINT32)
+
+        f4f_layout = splitter._scan_f4f_layout(f4v_parser)
+        for fe in (first_entry, second_entry):
+            fragment_length, reason = splitter._verify_fragment_layout(f4f_layout, fe.afra_offset)
+            self.assertEqual(reason, None)
+            self.assertEqual(splitter._read_fragment_length(f4v_parser, fe.afra_offset), fragment_length)
+
+        fragment_data = splitter._get_byterange(splitter.f4f_filename, second_entry.afra_offset, fragment_length)
+        boxes = list(F4VParser().parse(bytes_input=fragment_data))
+        self.assertEqual([box.header.box_type for box in boxes], HDSSegSplitter.REQUIRED_BOX_ORDER)
+        self.assertEqual(boxes[-1].payload, "y" * 3000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,410 @@
+""" Tests of the S3Inotifier splitting and upload pipeline. Run with:
+python -m unittest discover
+
+@author: Alastair McCormack
+@license: MIT License
+
+"""
+
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+from collections import deque
+from datetime import datetime
+from Queue import Empty
+from f4v_writer import SyntheticSegmentWriter
+from fragment_index import FragmentIndex, digest_of
+from hds_seg_fragmenter import HDSSegSplitter
+from S3Inotifier import (EventLoopDaemon, FileProcessor, LocalObjectStoreAdapter, PoisonedSegmentIndex, TransferFile,
+                         UploadScheduler)
+from test_bootstrap_diff import bootstrap_payload
+
+def transfer_file(remote_filename, live_edge_fragment=None):
+    payload = remote_filename
+    return TransferFile(create_time=datetime.now(), remote_filename=remote_filename, payload=payload,
+                        content_type=None, digest=digest_of(payload), live_edge_fragment=live_edge_fragment)
+
+class TempDirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_segment(self, name, fragment_count, bad_fragments=()):
+        """ Returns a SyntheticSegmentWriter whose index has been written.
+        The afra offsets of bad_fragments (1 based) point inside a box, so
+        they are quarantined by split(verify=True) """
+
+        basename = os.path.join(self.temp_dir, name + "Seg1")
+        segment_writer = SyntheticSegmentWriter(basename + ".f4x", basename + ".f4f", mdat_size=3000)
+
+        for _ in xrange(fragment_count):
+            segment_writer.append_fragment()
+
+        for fragment_number in bad_fragments:
+            afra_entry = segment_writer.global_entries[fragment_number - 1]
+            segment_writer.global_entries[fragment_number - 1] = afra_entry._replace(afra_offset=afra_entry.afra_offset + 1)
+
+        segment_writer.write_index()
+        return segment_writer
+
+
+class RecordingQueue(object):
+    """ Stands in for the upload queue. on_put, if given, is called before
+    each put """
+
+    def __init__(self, on_put=None):
+        self.on_put = on_put
+        self.remote_filenames = []
+
+    def put(self, tf):
+        if self.on_put:
+            self.on_put(tf)
+        self.remote_filenames.append(tf.remote_filename)
+
+
+class RecordingPool(object):
+    """ Stands in for a worker pool. Tasks are only run by run_next() """
+
+    def __init__(self):
+        self.tasks = deque()
+        self.task_count = 0
+
+    def apply_async(self, func, args, callback):
+        self.tasks.append((func, args, callback))
+        self.task_count += 1
+
+    def run_next(self):
+        func, args, callback = self.tasks.popleft()
+        callback(func(*args))
+
+
+class SynchronousPool(object):
+    """ Stands in for a worker pool, running each task as it is submitted """
+
+    def apply_async(self, func, args, callback):
+        callback(func(*args))
+
+
+class RecordingAdapter(object):
+
+    def __init__(self):
+        self.filenames = []
+
+    def upload(self, filename, contents_bytes, content_type=None, md5=None):
+        self.filenames.append(os.path.basename(filename))
+        return True
+
+
+class UploadSchedulerTest(unittest.TestCase):
+
+    def put_all(self, upload_scheduler, *tfs):
+        for tf in tfs:
+            upload_scheduler.put(tf)
+
+    def get_names(self, upload_scheduler, task_done=True):
+        """ Gets everything that can be got, in order """
+        names = []
+        while True:
+            try:
+                tf = upload_scheduler.get_nowait()
+            except Empty:
+                return names
+            names.append(tf.remote_filename)
+            if task_done:
+                upload_scheduler.task_done(tf)
+
+    def test_newest_fragment_first(self):
+        upload_scheduler = UploadScheduler()
+        self.put_all(upload_scheduler, *[transfer_file("sSeg1-Frag%d" % n) for n in xrange(1, 4)])
+        self.assertEqual(self.get_names(upload_scheduler), ["sSeg1-Frag3", "sSeg1-Frag2", "sSeg1-Frag1"])
+
+    def test_manifests_first(self):
+        upload_scheduler = UploadScheduler()
+        self.put_all(upload_scheduler, transfer_file("sSeg1-Frag1"), transfer_file("s.f4m"))
+        self.assertEqual(self.get_names(upload_scheduler), ["s.f4m", "sSeg1-Frag1"])
+
+    def test_live_edges_of_streams_are_interleaved(self):
+        upload_scheduler = UploadScheduler()
+        self.put_all(upload_scheduler, *[transfer_file("aSeg1-Frag%d" % n) for n in xrange(1, 4)])
+        self.put_all(upload_scheduler, transfer_file("bSeg1-Frag1"))
+
+        names = self.get_names(upload_scheduler)
+        self.assertEqual(sorted(names[:2]), ["aSeg1-Frag3", "bSeg1-Frag1"])
+
+    def test_bootstrap_held_until_live_edge_uploaded(self):
+        upload_scheduler = UploadScheduler()
+        self.put_all(upload_scheduler, transfer_file("s.bootstrap", live_edge_fragment=1), transfer_file("sSeg1-Frag1"))
+
+        fragment_tf = upload_scheduler.get_nowait()
+        self.assertEqual(fragment_tf.remote_filename, "sSeg1-Frag1")
+        # still uploading
+        self.assertRaises(Empty, upload_scheduler.get_nowait)
+
+        upload_scheduler.task_done(fragment_tf)
+        self.assertEqual(self.get_names(upload_scheduler), ["s.bootstrap"])
+        self.assertTrue(upload_scheduler.empty())
+
+    def test_backlog_does_not_hold_bootstrap(self):
+        upload_scheduler = UploadScheduler()
+        self.put_all(upload_scheduler, *[transfer_file("sSeg1-Frag%d" % n) for n in xrange(1, 6)])
+        self.put_all(upload_scheduler, transfer_file("s.bootstrap", live_edge_fragment=5))
+
+        self.assertEqual(self.get_names(upload_scheduler)[:2], ["sSeg1-Frag5", "s.bootstrap"])
+
+    def uploaded_scheduler(self, fragment_number):
+        """ Returns an UploadScheduler which has uploaded fragment_number """
+        upload_scheduler = UploadScheduler()
+        self.put_all(upload_scheduler, transfer_file("sSeg1-Frag%d" % fragment_number))
+        self.get_names(upload_scheduler)
+        return upload_scheduler
+
+    def test_newer_bootstrap_supersedes(self):
+        upload_scheduler = self.uploaded_scheduler(6)
+        old_bootstrap = transfer_file("s.bootstrap", live_edge_fragment=5)
+        new_bootstrap = transfer_file("s.bootstrap", live_edge_fragment=6)
+        self.put_all(upload_scheduler, old_bootstrap, new_bootstrap)
+
+        self.assertEqual(len(upload_scheduler), 1)
+        self.assertTrue(upload_scheduler.get_nowait() is new_bootstrap)
+
+    def test_older_bootstrap_does_not_supersede(self):
+        upload_scheduler = self.uploaded_scheduler(6)
+        new_bootstrap = transfer_file("s.bootstrap", live_edge_fragment=6)
+        old_bootstrap = transfer_file("s.bootstrap", live_edge_fragment=5)
+        self.put_all(upload_scheduler, new_bootstrap, old_bootstrap)
+
+        self.assertEqual(len(upload_scheduler), 1)
+        self.assertTrue(upload_scheduler.get_nowait() is new_bootstrap)
+
+    def test_bootstrap_released_after_hold(self):
+        upload_scheduler = UploadScheduler(bootstrap_hold=0.05)
+        # fragment 9 is never queued, e.g. because it was quarantined
+        self.put_all(upload_scheduler, transfer_file("s.bootstrap", live_edge_fragment=9))
+
+        self.assertRaises(Empty, upload_scheduler.get_nowait)
+        self.assertEqual(upload_scheduler.get(timeout=1).remote_filename, "s.bootstrap")
+
+    def test_fifo_order(self):
+        upload_scheduler = UploadScheduler(prioritise=False)
+        self.put_all(upload_scheduler, *[transfer_file("sSeg1-Frag%d" % n) for n in xrange(1, 4)])
+        self.assertEqual(self.get_names(upload_scheduler), ["sSeg1-Frag1", "sSeg1-Frag2", "sSeg1-Frag3"])
+
+    def test_fifo_holds_bootstrap(self):
+        upload_scheduler = UploadScheduler(prioritise=False)
+        self.put_all(upload_scheduler, transfer_file("sSeg1-Frag1"), transfer_file("s.bootstrap", live_edge_fragment=2),
+                     transfer_file("sSeg1-Frag2"))
+
+        first_tf = upload_scheduler.get_nowait()
+        second_tf = upload_scheduler.get_nowait()
+        self.assertEqual([first_tf.remote_filename, second_tf.remote_filename], ["sSeg1-Frag1", "sSeg1-Frag2"])
+        self.assertRaises(Empty, upload_scheduler.get_nowait)
+
+        upload_scheduler.task_done(first_tf)
+        self.assertRaises(Empty, upload_scheduler.get_nowait)
+
+        upload_scheduler.task_done(second_tf)
+        self.assertEqual(self.get_names(upload_scheduler), ["s.bootstrap"])
+
+    def test_drains(self):
+        upload_scheduler = UploadScheduler()
+        names = []
+        for n in xrange(1, 21):
+            for stream_name in ("a", "b"):
+                name = "%sSeg1-Frag%d" % (stream_name, n)
+                names.append(name)
+                self.put_all(upload_scheduler, transfer_file(name),
+                             transfer_file(stream_name + ".bootstrap", live_edge_fragment=n))
+
+        got_names = self.get_names(upload_scheduler)
+        self.assertEqual(sorted(got_names), sorted(names + ["a.bootstrap", "b.bootstrap"]))
+        self.assertTrue(upload_scheduler.empty())
+        self.assertEqual(upload_scheduler.live_edge_lags()[0].fragments_behind, 0)
+
+
+class PoisonedSegmentTest(TempDirTestCase):
+
+    def test_poisoned_until_changed(self):
+        segment_writer = self.write_segment("stream", 1)
+        splitter = HDSSegSplitter(segment_writer.f4x_filename)
+        poisoned_segments = PoisonedSegmentIndex()
+
+        self.assertFalse(poisoned_segments.is_poisoned(splitter))
+        poisoned_segments.poison(splitter, poisoned_segments.signature(splitter), "test")
+        self.assertTrue(poisoned_segments.is_poisoned(splitter))
+
+        segment_writer.append_fragment()
+        segment_writer.write_index()
+        self.assertFalse(poisoned_segments.is_poisoned(splitter))
+
+    def test_removed_segment_is_not_poisoned(self):
+        segment_writer = self.write_segment("stream", 1)
+        splitter = HDSSegSplitter(segment_writer.f4x_filename)
+        os.remove(segment_writer.f4f_filename)
+
+        poisoned_segments = PoisonedSegmentIndex()
+        poisoned_segments.poison(splitter, poisoned_segments.signature(splitter), "test")
+        self.assertEqual(len(poisoned_segments._segments), 0)
+
+    def test_oldest_segments_are_forgotten(self):
+        poisoned_segments = PoisonedSegmentIndex(maxlen=2)
+        splitters = []
+        for name in ("a", "b", "c"):
+            splitter = HDSSegSplitter(self.write_segment(name, 1).f4x_filename)
+            poisoned_segments.poison(splitter, poisoned_segments.signature(splitter), "test")
+            splitters.append(splitter)
+
+        self.assertEqual([poisoned_segments.is_poisoned(splitter) for splitter in splitters], [False, True, True])
+
+
+class LocalObjectStoreAdapterTest(TempDirTestCase):
+
+    def test_stores_objects(self):
+        file_adapter = LocalObjectStoreAdapter(self.temp_dir)
+        file_adapter.upload("/hds/a", "one", content_type="video/f4f")
+
+        with open(os.path.join(self.temp_dir, "hds", "a"), "rb") as f:
+            self.assertEqual(f.read(), "one")
+        self.assertEqual(file_adapter.etags["/hds/a"], digest_of("one").md5)
+        self.assertEqual(file_adapter.content_types["/hds/a"], "video/f4f")
+
+    def test_remembers_newest_objects(self):
+        file_adapter = LocalObjectStoreAdapter(self.temp_dir, maxlen=2)
+        for name in ("a", "b", "a", "c"):
+            file_adapter.upload("/hds/" + name, name)
+
+        self.assertEqual(list(file_adapter.etags), ["/hds/a", "/hds/c"])
+        self.assertEqual(list(file_adapter.content_types), ["/hds/a", "/hds/c"])
+
+
+class FileProcessorTest(TempDirTestCase):
+
+    def test_segment_grown_during_failed_split_is_split_again(self):
+        segment_writer = self.write_segment("stream", 2, bad_fragments=[2])
+
+        def grow_segment(tf):
+            # the packager appends a fragment while the split is running
+            if len(segment_writer.global_entries) == 2:
+                segment_writer.append_fragment()
+                segment_writer.write_index()
+
+        send_queue = RecordingQueue(on_put=grow_segment)
+        poisoned_segments = PoisonedSegmentIndex()
+        file_processor = FileProcessor(None, send_queue, processed_frags=deque(), poisoned_segments=poisoned_segments,
+                                       bootstrap_publisher=None)
+
+        file_processor.process_segment(segment_writer.f4x_filename)
+        self.assertEqual(send_queue.remote_filenames, ["streamSeg1-Frag1"])
+        self.assertFalse(poisoned_segments.is_poisoned(HDSSegSplitter(segment_writer.f4x_filename)))
+
+        file_processor.process_segment(segment_writer.f4x_filename)
+        self.assertEqual(send_queue.remote_filenames, ["streamSeg1-Frag1", "streamSeg1-Frag3"])
+
+    def test_unchanged_segment_is_skipped(self):
+        segment_writer = self.write_segment("stream", 2, bad_fragments=[2])
+
+        send_queue = RecordingQueue()
+        poisoned_segments = PoisonedSegmentIndex()
+        file_processor = FileProcessor(None, send_queue, processed_frags=deque(), poisoned_segments=poisoned_segments,
+                                       bootstrap_publisher=None)
+
+        file_processor.process_segment(segment_writer.f4x_filename)
+        self.assertTrue(poisoned_segments.is_poisoned(HDSSegSplitter(segment_writer.f4x_filename)))
+
+        # Frag1 would be skipped as processed anyway, so forget it
+        file_processor.processed_frags.clear()
+        file_processor.process_segment(segment_writer.f4x_filename)
+        self.assertEqual(send_queue.remote_filenames, ["streamSeg1-Frag1"])
+
+
+
+class EventLoopDaemonTest(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+
+        self.file_adapter = RecordingAdapter()
+        self.daemon = EventLoopDaemon(self.temp_dir, lambda: self.file_adapter, FragmentIndex(),
+                                      upload_scheduler=UploadScheduler(bootstrap_hold=0.3))
+        self.daemon.split_pool = RecordingPool()
+        self.daemon.upload_pool = SynchronousPool()
+
+    def tearDown(self):
+        os.close(self.daemon._wakeup_read)
+        os.close(self.daemon._wakeup_write)
+        TempDirTestCase.tearDown(self)
+
+    def test_segment_changed_during_failed_split_is_split_again(self):
+        segment_writer = self.write_segment("stream", 2, bad_fragments=[2])
+        split_pool = self.daemon.split_pool
+
+        self.daemon._submit_split(segment_writer.f4x_filename)
+        # the packager appends a fragment while the split is running
+        segment_writer.append_fragment()
+        segment_writer.write_index()
+        self.daemon._submit_split(segment_writer.f4x_filename)
+        self.assertEqual(split_pool.task_count, 1)
+
+        split_pool.run_next()
+        self.daemon._handle_completions()
+        self.assertEqual(split_pool.task_count, 2)
+
+        split_pool.run_next()
+        self.daemon._run_once()
+        self.assertEqual(self.file_adapter.filenames, ["streamSeg1-Frag3", "streamSeg1-Frag1"])
+
+    def test_drain_waits_for_held_bootstrap(self):
+        # fragment 9 is never queued, so the bootstrap is held for bootstrap_hold
+        self.daemon.upload_scheduler.put(TransferFile(create_time=datetime.now(), remote_filename="stream.bootstrap",
+                                                      payload="", content_type=None, digest=digest_of(""),
+                                                      live_edge_fragment=9))
+        run_count = [0]
+        run_once = self.daemon._run_once
+
+        def counting_run_once():
+            run_count[0] += 1
+            run_once()
+
+        self.daemon._run_once = counting_run_once
+
+        drain_start = time.time()
+        self.daemon._drain()
+
+        self.assertTrue(time.time() - drain_start >= 0.3)
+        self.assertTrue(run_count[0] < 10, "%d iterations" % run_count[0])
+        self.assertEqual(self.file_adapter.filenames, ["stream.bootstrap"])
+
+    def test_bootstraps_are_prepared_in_worker_pool(self):
+        bootstrap_filename = os.path.join(self.temp_dir, "stream.bootstrap")
+        with open(bootstrap_filename, "wb") as f:
+            f.write(bootstrap_payload(1))
+
+        # the live edge fragment is uploaded first
+        self.daemon.upload_scheduler.put(transfer_file("streamSeg1-Frag1"))
+        self.daemon._run_once()
+
+        split_pool = self.daemon.split_pool
+        # several events for one write are prepared once
+        for _ in xrange(3):
+            self.daemon.events.put(bootstrap_filename)
+        self.daemon._run_once()
+        self.assertEqual(split_pool.task_count, 1)
+
+        split_pool.run_next()
+        self.daemon._run_once()
+        self.assertEqual(split_pool.task_count, 2)
+        self.assertEqual(self.file_adapter.filenames, ["streamSeg1-Frag1", "stream.bootstrap"])
+
+        # unchanged, so not published again
+        split_pool.run_next()
+        self.daemon._run_once()
+        self.assertEqual(self.file_adapter.filenames, ["streamSeg1-Frag1", "stream.bootstrap"])
+        self.assertFalse(self.daemon._has_pending_work())
+
+
+if __name__ == "__main__":
+    unittest.main()